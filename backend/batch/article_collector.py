@@ -2,109 +2,173 @@
 """
 記事データ収集モジュール (NewsAPI)
 - NewsApiClient を使ってパンダに関する記事を取得
-- 画像はまず API の urlToImage を使い、なければ utils.py で補完
+- 画像はまず API の urlToImage を使い、なければ記事ページから補完 (image_enricher)
 """
 
 import time
+from datetime import datetime
 from urllib.parse import urlparse
-from typing import Optional, List
+from typing import Collection, Iterator, Optional, List
 # 共通ヘルパーをインポート
-from utils import parse_published, get_main_image, validate_image_url
+from utils import parse_published
+from image_enricher import ENRICH_CONCURRENCY, IMAGE_HINT_KEY, iter_enriched
+from keyword_matcher import get_keyword_matcher
+from state_store import Checkpoint, HighWaterMark, iter_committing
+from metrics import incr, timer
 
-# NewsAPI クライアントのインポート試行
-try:
-    from newsapi import NewsApiClient
-except Exception:
-    NewsApiClient = None
+# 最終的に採用する記事のタイトルに含まれるべきキーワード
+TITLE_KEYWORDS = ["panda", "パンダ", "香香", "シャンシャン"]
 
-def fetch_from_newsapi(newsapi_key: str, max_pages: int = 1, page_size: int = 100) -> List[dict]:
+# --- ★ 検索クエリをパンダに特化 (sources.toml の options.query で変更可) ---
+NEWSAPI_QUERY = (
+    '('
+    'panda OR パンダ OR "giant panda" OR ジャイアントパンダ OR '
+    'シャンシャン OR 香香 OR "アドベンチャーワールド" OR "上野動物園" '
+    ') '
+    # 必要に応じて除外キーワードを追加
+    'NOT (software OR python OR data OR express OR "Panda Security")'
+)
+NEWSAPI_LANGUAGES = ["en"]
+
+
+def _iter_raw_newsapi(newsapi_key: str, max_pages: int, page_size: int,
+                      known_urls: Optional[Collection[str]], incremental: bool, checkpoint: Checkpoint,
+                      query: str = NEWSAPI_QUERY,
+                      title_keywords: Optional[List[str]] = None,
+                      languages: Optional[List[str]] = None) -> Iterator[dict]:
     """
-    NewsAPIからパンダ関連ニュースを収集し、処理済みの記事辞書のリストを返す。
-    (関数名を変更)
+    [内部] NewsAPIからパンダ関連ニュースを収集し、画像を補完する前の記事辞書を 1 件ずつ返す。
+    - known_urls: DB に保存済みの記事URL。該当する記事は画像処理の前に除外する
+      (UrlKeySet なら、他のソースが処理中の記事も image_enricher が補完の前に除く)
+    - incremental: True なら前回の収集位置 (HighWaterMark) 以降の記事だけを問い合わせ、
+      前回処理した記事に達したらページングを止める
+    - checkpoint: 返す記事に印を付け、最後まで取得できたら収集位置の確定を登録する (確定は記事が保存されてから)
+    - query / languages: 検索クエリと言語 (None の場合は NEWSAPI_LANGUAGES)
+    - title_keywords: タイトルに含まれるべきキーワード (None の場合は TITLE_KEYWORDS)
     """
 
-    if not NewsApiClient:
-        print(" [NewsAPI] newsapi ライブラリが見つかりません。pip install newsapi-python を実行してください。")
-        return []
-    
     if not newsapi_key:
         print(" [NewsAPI] NewsAPIキーが提供されていません。")
-        return []
+        return
+
+    # NewsAPI クライアントのインポート試行 (キーがあって実際に収集するときだけ読み込む)
+    try:
+        from newsapi import NewsApiClient
+    except Exception:
+        print(" [NewsAPI] newsapi ライブラリが見つかりません。pip install newsapi-python を実行してください。")
+        return
 
     client = NewsApiClient(api_key=newsapi_key)
 
-    # --- ★ 検索クエリをパンダに特化 ---
-    query = (
-        '('
-        'panda OR パンダ OR "giant panda" OR ジャイアントパンダ OR '
-        'シャンシャン OR 香香 OR "アドベンチャーワールド" OR "上野動物園" '
-        ') '
-        # 必要に応じて除外キーワードを追加
-        'NOT (software OR python OR data OR express OR "Panda Security")'
-    )
-
-    languages = ["en"]
-    collected_articles = [] # 収集した記事を格納するリスト
-    
-    print(f"--- NewsAPI 実行中 (q={query}) ---")
-
-    for lang in languages:
+    title_matcher = get_keyword_matcher(title_keywords or TITLE_KEYWORDS)
+    mark = HighWaterMark("newsapi") if incremental else None
+    # 前回の最新記事の少し前から問い合わせる (Unix 時刻は UTC として送られる。初回は期間指定なし)
+    since = mark.since if mark else None
+    completed = True
+    skipped_seen = 0
+
+    since_label = datetime.fromtimestamp(since).isoformat(timespec="seconds") if since else "指定なし"
+    print(f"--- NewsAPI 実行中 (q={query}, from={since_label}) ---")
+
+    for lang in languages or NEWSAPI_LANGUAGES:
         for page in range(1, max_pages + 1):
             try:
-                res = client.get_everything(
-                    q=query,
-                    language=lang,
-                    page=page,
-                    page_size=page_size,
-                    sort_by="publishedAt"
-                )
+                with timer("newsapi.request"):
+                    res = client.get_everything(
+                        q=query,
+                        language=lang,
+                        page=page,
+                        page_size=page_size,
+                        sort_by="publishedAt",
+                        from_param=since,
+                    )
             except Exception as e:
                 print(f" [NewsAPI 取得失敗] lang={lang} page={page} : {e}")
+                completed = False
                 break
 
             articles = res.get("articles") or []
+            incr("newsapi.items", len(articles))
             if not articles:
                 break
 
+            reached_seen = False
             for item in articles:
                 url = (item.get("url") or "").strip()
                 if not url:
                     continue
 
-                title = item.get("title") or "(無題)"
-                # ★ 共通ヘルパーを使用
+                # 前回処理した記事は読み飛ばす (新しい順なので、以降のページも取得しない)
                 published_dt = parse_published(item.get("publishedAt") or item.get("published"))
-                image_url = item.get("urlToImage") or item.get("image")
-                source_name = (item.get("source") or {}).get("name") or ""
+                if mark:
+                    if mark.is_known(url, published_dt):
+                        skipped_seen += 1
+                        reached_seen = True
+                        continue
+                    mark.observe(url, published_dt)
+
+                title = item.get("title") or "(無題)"
+
+                # タイトルに「パンダ」関連の単語が含まれるものだけを最終的に採用する
+                # (画像の検証・スクレイピングより前に判定し、不採用の記事に通信しない)
+                if not title_matcher.search(title.lower()):
+                    continue
 
-                # --- 画像検証＆補完 (共通ヘルパーを使用) ---
-                if image_url:
-                    image_url = image_url.strip()
-                    if not validate_image_url(image_url):
-                        print(f" [API画像無効] {image_url}")
-                        image_url = None
+                # DB保存済みの記事は画像処理をせずに除外
+                if known_urls and url in known_urls:
+                    continue
 
-                if not image_url:
-                    print("   メイン画像を取得中 (スクレイピング fallback)...")
-                    # ★ 共通ヘルパーを使用
-                    scraped = get_main_image(url)
-                    if scraped:
-                        image_url = scraped
+                source_name = (item.get("source") or {}).get("name") or ""
 
+                # 画像の検証・補完は image_enricher でまとめて並列に行う
+                # (API の urlToImage はヒントとして渡し、無効なら記事ページから探す)
                 article = {
                     "title": title,
                     "article_url": url,
                     "published_at": published_dt.isoformat(),
                     "source_name": source_name or urlparse(url).netloc,
-                    "image_url": image_url,
+                    "image_url": None,
+                    IMAGE_HINT_KEY: item.get("urlToImage") or item.get("image"),
                 }
+                print(f" [NewsAPI] 新規記事候補: {article['title']}")
+                incr("newsapi.articles")
+                yield checkpoint.hold(article)
                 
-                # タイトルに「パンダ」関連の単語が含まれるものだけを最終的に採用する
-                if "panda" in title.lower() or "パンダ" in title or "香香" in title or "シャンシャン" in title:
-                    print(f" [NewsAPI] 新規記事候補: {article['title']}")
-                    collected_articles.append(article)
-                
+            if reached_seen:
+                break
+
             # レート制限対策
             time.sleep(0.3)
 
-    return collected_articles
\ No newline at end of file
+    if skipped_seen:
+        print(f" [NewsAPI] 前回処理済みの記事 {skipped_seen} 件を読み飛ばしました")
+    # 取得に失敗せず最後まで処理できたときだけ位置を進める
+    if mark and completed:
+        checkpoint.on_commit(mark.commit)
+
+
+def iter_from_newsapi(newsapi_key: str, max_pages: int = 1, page_size: int = 100,
+                      known_urls: Optional[Collection[str]] = None, incremental: bool = True,
+                      query: str = NEWSAPI_QUERY, title_keywords: Optional[List[str]] = None,
+                      languages: Optional[List[str]] = None,
+                      max_in_flight: int = ENRICH_CONCURRENCY,
+                      checkpoint: Optional[Checkpoint] = None) -> Iterator[dict]:
+    """
+    NewsAPIからパンダ関連ニュースを収集し、画像を補完した記事辞書を 1 件ずつ返す。
+    画像の検証・補完は image_enricher で最大 max_in_flight 件ずつ並列に行う
+    checkpoint が None なら、返した記事をすべて受け取ってもらえたときに収集位置を確定する
+    (その他の引数は _iter_raw_newsapi を参照)
+    """
+    standalone = checkpoint is None
+    if standalone:
+        checkpoint = Checkpoint("NewsAPI")
+    articles = iter_enriched(_iter_raw_newsapi(newsapi_key, max_pages, page_size, known_urls, incremental,
+                                               checkpoint, query, title_keywords, languages), max_in_flight,
+                             known_urls=known_urls)
+    return iter_committing(articles, checkpoint) if standalone else articles
+
+
+def fetch_from_newsapi(newsapi_key: str, max_pages: int = 1, page_size: int = 100,
+                       known_urls: Optional[Collection[str]] = None, incremental: bool = True) -> List[dict]:
+    """iter_from_newsapi の結果をリストで返す"""
+    return list(iter_from_newsapi(newsapi_key, max_pages, page_size, known_urls, incremental))
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+バッチのベンチマークスクリプト
+- ローカルの HTTP サーバーで外部サービスの代役を立て、本番のサイトや API に接続せずに計測する
+  (RSS フィード / 記事HTML / 画像 / NewsAPI / Custom Search / Supabase (PostgREST))
+- 記事HTMLは og:image, JSON-LD, 本文 <img> だけ, 画像なし の 4 種類を混ぜて返す
+- 記事と画像の応答には遅延と失敗 (404) を指定した割合で混ぜられる
+- validate_image_url, get_main_image, fetch_from_rss, main() 全体 の所要時間を計測し、
+  レイテンシのパーセンタイルとスループットを表示する
+  (--json で結果を保存し、--baseline で以前の結果と比較できる)
+
+使い方 (backend ディレクトリから):
+    python batch/benchmark.py
+    python batch/benchmark.py --latency-ms 50 --failure-rate 0.2 --json bench.json
+    python batch/benchmark.py --baseline bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+# 画像の大きさ (幅, 高さ)。小さいものはトラッキングピクセル / アイコンとして除外される
+IMAGE_SIZES = [(1200, 630), (800, 600), (640, 480), (1, 1), (32, 32)]
+ARTICLE_VARIANTS = ["og", "jsonld", "img", "none"]
+FAKE_SUPABASE_KEY = "bench.bench.bench"
+
+
+# ---------------------------------------------------------------------------
+# ローカルの代役サーバー
+# ---------------------------------------------------------------------------
+
+def _png(width: int, height: int, size: int) -> bytes:
+    """幅・高さを持つ PNG を作る (size バイトに届くまで tEXt チャンクで水増しする)"""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    ihdr = chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+    idat = chunk(b"IDAT", zlib.compress(b"\x00" * min(width * 3 + 1, 4096)))
+    padding = max(0, size - len(ihdr) - len(idat) - 20)
+    text = chunk(b"tEXt", b"bench\x00" + b"x" * padding) if padding else b""
+    return b"\x89PNG\r\n\x1a\n" + ihdr + text + idat + chunk(b"IEND", b"")
+
+
+class StandInServer:
+    """外部サービスの代役をまとめて提供するローカル HTTP サーバー"""
+
+    def __init__(self, latency_ms: float, failure_rate: float, page_kb: int, image_kb: int,
+                 feeds: int, entries_per_feed: int, seed: int):
+        self.latency = latency_ms / 1000.0
+        self.failure_rate = failure_rate
+        self.page_kb = page_kb
+        self.image_kb = image_kb
+        self.feeds = feeds
+        self.entries_per_feed = entries_per_feed
+        self.random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._images: Dict[tuple, bytes] = {}
+        self.rows: Dict[str, dict] = {}  # Supabase の articles テーブルの代わり
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def start(self) -> "StandInServer":
+        threading.Thread(target=self.httpd.serve_forever, name="bench-server", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+    # --- 応答の揺らぎ ---
+    def _sleep(self) -> None:
+        if self.latency > 0:
+            with self._random_lock:
+                jitter = self.random.uniform(0.5, 1.5)
+            time.sleep(self.latency * jitter)
+
+    def _fails(self) -> bool:
+        with self._random_lock:
+            return self.random.random() < self.failure_rate
+
+    def image(self, width: int, height: int) -> bytes:
+        key = (width, height)
+        if key not in self._images:
+            self._images[key] = _png(width, height, self.image_kb * 1024)
+        return self._images[key]
+
+    # --- コンテンツ ---
+    def feed_xml(self, feed: int, run: str) -> bytes:
+        items = []
+        for i in range(self.entries_per_feed):
+            topic = "Giant panda cub" if i % 3 == 0 else "Market update"
+            link = f"{self.base}/articles/f{feed}-{i}?r={run}&utm_source=rss"
+            items.append(
+                f"<item><title>{topic} {feed}-{i}</title><link>{link}</link>"
+                f"<guid>{link}</guid><description>{topic} news</description>"
+                f"<pubDate>{time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(time.time() - i * 600))}</pubDate></item>"
+            )
+        return (f'<?xml version="1.0"?><rss version="2.0"><channel><title>Bench feed {feed}</title>'
+                f"<link>{self.base}</link>{''.join(items)}</channel></rss>").encode()
+
+    def article_html(self, name: str) -> bytes:
+        variant = ARTICLE_VARIANTS[sum(map(ord, name)) % len(ARTICLE_VARIANTS)]
+        img = f"{self.base}/images/{name}.png"
+        head = [f"<title>{name}</title>", f'<link rel="canonical" href="{self.base}/articles/{name}">']
+        body = [f"<h1>Panda {name}</h1>"]
+        if variant == "og":
+            head.append(f'<meta property="og:image" content="{img}?w=1200&h=630">')
+        elif variant == "jsonld":
+            head.append('<script type="application/ld+json">'
+                        + json.dumps({"@type": "NewsArticle", "image": {"url": f"{img}?w=800&h=600"}})
+                        + "</script>")
+        elif variant == "img":
+            body.append(f'<article><img src="{img}?w=1&h=1"><img src="{img}?w=640&h=480"></article>')
+        filler = "<p>" + "panda " * 150 + "</p>"
+        body.extend([filler] * max(1, (self.page_kb * 1024) // len(filler)))
+        return f"<html><head>{''.join(head)}</head><body>{''.join(body)}</body></html>".encode()
+
+    def newsapi_json(self, query: dict) -> bytes:
+        page_size = int(query.get("pageSize", ["100"])[0])
+        articles = []
+        for i in range(page_size):
+            sizes = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+            url_to_image = None if i % 4 == 3 else f"{self.base}/images/news-{i}.png?w={sizes[0]}&h={sizes[1]}"
+            articles.append({
+                "source": {"id": None, "name": "Bench News"},
+                "title": f"Panda news {i}" if i % 2 == 0 else f"Other news {i}",
+                "url": f"{self.base}/articles/news-{i}",
+                "urlToImage": url_to_image,
+                "publishedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - i * 300)),
+            })
+        return json.dumps({"status": "ok", "totalResults": len(articles), "articles": articles}).encode()
+
+    def customsearch_json(self, query: dict) -> bytes:
+        start = int(query.get("start", ["1"])[0])
+        num = int(query.get("num", ["10"])[0])
+        items = []
+        for i in range(start, min(start + num, 101)):
+            sizes = IMAGE_SIZES[i % len(IMAGE_SIZES)]
+            items.append({
+                "title": f"Panda image {i}",
+                "link": f"{self.base}/images/cse-{i}.png?w={sizes[0]}&h={sizes[1]}",
+                "displayLink": "bench.example",
+                "image": {"contextLink": f"{self.base}/articles/cse-{i}"},
+            })
+        return json.dumps({"searchInformation": {"totalResults": "100"}, "items": items}).encode()
+
+    # --- ハンドラー ---
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b"", content_type: str = "text/plain",
+                      headers: Optional[dict] = None) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _read_body(self) -> bytes:
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                server.requests += 1
+                parts = urlsplit(self.path)
+                query = parse_qs(parts.query)
+                path = parts.path
+                if path.startswith("/feeds/"):
+                    feed = int(path.rsplit("/", 1)[1].split(".")[0])
+                    return self._send(200, server.feed_xml(feed, query.get("r", ["0"])[0]), "application/rss+xml")
+                if path.startswith("/articles/"):
+                    server._sleep()
+                    if server._fails():
+                        return self._send(404, b"not found")
+                    return self._send(200, server.article_html(path.rsplit("/", 1)[1]), "text/html; charset=utf-8")
+                if path.startswith("/images/"):
+                    server._sleep()
+                    if server._fails():
+                        return self._send(404, b"not found")
+                    body = server.image(int(query.get("w", ["800"])[0]), int(query.get("h", ["600"])[0]))
+                    rng = self.headers.get("Range")
+                    if rng and rng.startswith("bytes="):
+                        first, _, last = rng[6:].partition("-")
+                        first, last = int(first or 0), min(int(last or len(body) - 1), len(body) - 1)
+                        return self._send(206, body[first:last + 1], "image/png",
+                                          {"Content-Range": f"bytes {first}-{last}/{len(body)}"})
+                    return self._send(200, body, "image/png")
+                if path == "/v2/everything":
+                    return self._send(200, server.newsapi_json(query), "application/json")
+                if path == "/customsearch/v1":
+                    return self._send(200, server.customsearch_json(query), "application/json")
+                if path == "/rest/v1/articles":
+                    # 既存記事の取得 / 削除対象の取得。どちらも空で返す
+                    return self._send(200, b"[]", "application/json", {"Content-Range": "*/0"})
+                return self._send(404, b"not found")
+
+            def do_POST(self):
+                server.requests += 1
+                if urlsplit(self.path).path != "/rest/v1/articles":
+                    return self._send(404, b"not found")
+                rows = json.loads(self._read_body() or b"[]")
+                rows = rows if isinstance(rows, list) else [rows]
+                inserted = 0
+                for row in rows:
+                    if row.get("article_url") not in server.rows:
+                        server.rows[row.get("article_url")] = row
+                        inserted += 1
+                self._send(201, b"", "application/json", {"Content-Range": f"*/{inserted}"})
+
+            def do_DELETE(self):
+                server.requests += 1
+                self._send(204, b"", "application/json", {"Content-Range": "*/0"})
+
+        return Handler
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], wall: float) -> dict:
+    """レイテンシ (秒) のリストから統計 (ミリ秒) とスループットを計算する"""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "mean_ms": 1000 * sum(values) / len(values) if values else 0.0,
+        "p50_ms": 1000 * _percentile(values, 50),
+        "p90_ms": 1000 * _percentile(values, 90),
+        "p99_ms": 1000 * _percentile(values, 99),
+        "max_ms": 1000 * (values[-1] if values else 0.0),
+        "throughput_per_s": len(values) / wall if wall > 0 else 0.0,
+    }
+
+
+def measure(name: str, calls: List[Callable[[], object]], verbose: bool) -> dict:
+    """calls を順番に実行して 1 件ごとの所要時間を計測する (バッチのログは verbose 時のみ表示)"""
+    latencies = []
+    sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with sink:
+        for call in calls:
+            t0 = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - t0)
+    result = summarize(latencies, time.perf_counter() - started)
+    print(f"  {name:<28} n={result['count']:<4} mean={result['mean_ms']:8.1f}ms  p50={result['p50_ms']:8.1f}ms  "
+          f"p90={result['p90_ms']:8.1f}ms  p99={result['p99_ms']:8.1f}ms  {result['throughput_per_s']:7.1f}/s")
+    return result
+
+
+def compare(results: Dict[str, dict], baseline_path: str) -> None:
+    """以前の --json の結果と p50 / p90 を比較して表示する"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f).get("results", {})
+    print(f"\n--- ベースライン ({baseline_path}) との比較 ---")
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        deltas = []
+        for key in ("p50_ms", "p90_ms"):
+            if before.get(key):
+                deltas.append(f"{key[:3]} {100.0 * (current[key] - before[key]) / before[key]:+6.1f}%")
+        print(f"  {name:<28} {'  '.join(deltas)}")
+
+
+def run(args) -> Dict[str, dict]:
+    server = StandInServer(args.latency_ms, args.failure_rate, args.page_kb, args.image_kb,
+                           args.feeds, args.entries_per_feed, args.seed).start()
+
+    # 計測用の状態・キャッシュは一時ディレクトリに置き、本番のキャッシュを汚さない
+    state_dir = tempfile.mkdtemp(prefix="batch-bench-")
+    os.environ["BATCH_STATE_DIR"] = state_dir
+    os.environ["BATCH_CACHE_DB"] = ""
+    os.environ["GOOGLE_DAILY_QUOTA"] = "100000"
+    # sources.toml の上書きは使わず、既定のソース一覧 (代役サーバーに向けた RSS_FEEDS) で動かす
+    os.environ["BATCH_SOURCES_CONFIG"] = os.path.join(state_dir, "sources.toml")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import newsapi.const
+    import main as batch_main
+    import rss_collector
+    import search_panda_images
+    from host_guard import HOST_GUARD
+    from utils import get_main_image, validate_image_url
+
+    # 代役サーバーは 1 ホストなので、ホストごとの流量制限は外しておく
+    HOST_GUARD.rate = HOST_GUARD.burst = 1_000_000
+    newsapi.const.EVERYTHING_URL = f"{server.base}/v2/everything"
+    search_panda_images.API_URL = f"{server.base}/customsearch/v1"
+
+    base = server.base
+    n = args.iterations
+    results: Dict[str, dict] = {}
+    print(f"--- ベンチマーク (遅延 {args.latency_ms:g}ms, 失敗率 {args.failure_rate:.0%}, 反復 {n}) ---")
+
+    # 1) 画像URLの検証 (毎回別のURLにしてキャッシュを効かせない)
+    results["validate_image_url"] = measure("validate_image_url", [
+        (lambda i=i: validate_image_url(
+            f"{base}/images/v{i}.png?w={IMAGE_SIZES[i % len(IMAGE_SIZES)][0]}&h={IMAGE_SIZES[i % len(IMAGE_SIZES)][1]}",
+            use_cache=False))
+        for i in range(n)
+    ], args.verbose)
+
+    # 2) 記事ページからのメイン画像の取得 (4 種類のHTMLを順に)
+    results["get_main_image"] = measure("get_main_image", [
+        (lambda i=i: get_main_image(f"{base}/articles/main-{i}", use_cache=False)) for i in range(n)
+    ], args.verbose)
+
+    # 3) RSS の巡回 (フィードのパースとキーワード照合のみ / 画像の補完あり)
+    feeds = lambda run: [f"{base}/feeds/{f}.xml?r={run}" for f in range(args.feeds)]
+    results["fetch_from_rss"] = measure("fetch_from_rss", [
+        (lambda r=r: rss_collector.fetch_from_rss(feeds(f"p{r}"), conditional_get=False, incremental=False))
+        for r in range(args.rss_runs)
+    ], args.verbose)
+    results["fetch_from_rss(images)"] = measure("fetch_from_rss(images)", [
+        (lambda r=r: rss_collector.fetch_from_rss(feeds(f"i{r}"), fetch_images=True,
+                                                  conditional_get=False, incremental=False))
+        for r in range(args.rss_runs)
+    ], args.verbose)
+
+    # 4) main() 全体 (Google / NewsAPI / RSS → 保存 → 削除)
+    if args.main_runs:
+        os.environ.update({
+            "SUPABASE_URL": base, "SUPABASE_KEY": FAKE_SUPABASE_KEY,
+            "GOOGLE_API_KEY": "bench", "CUSTOM_SEARCH_CX": "bench", "NEWS_API_KEY": "bench",
+        })
+        rss_collector.RSS_FEEDS = feeds("main")
+        saved_argv = sys.argv
+        sys.argv = [saved_argv[0]]
+        try:
+            results["main"] = measure("main", [batch_main.main] * args.main_runs, args.verbose)
+        finally:
+            sys.argv = saved_argv
+        print(f"  (main: 保存された記事 {len(server.rows)} 件)")
+
+    print(f"  (代役サーバーへのリクエスト: {server.requests} 件)")
+    server.stop()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ローカルの代役サーバーを使ったバッチのベンチマーク")
+    parser.add_argument("--iterations", type=int, default=40, help="validate_image_url / get_main_image の呼び出し回数")
+    parser.add_argument("--rss-runs", type=int, default=3, help="fetch_from_rss の実行回数")
+    parser.add_argument("--main-runs", type=int, default=1, help="main() の実行回数 (0 で省略)")
+    parser.add_argument("--feeds", type=int, default=8, help="フィード数")
+    parser.add_argument("--entries-per-feed", type=int, default=30, help="1 フィードあたりのエントリー数")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="記事・画像の応答遅延 (±50%% の揺らぎ)")
+    parser.add_argument("--failure-rate", type=float, default=0.1, help="記事・画像が 404 になる割合")
+    parser.add_argument("--page-kb", type=int, default=60, help="記事HTMLの大きさ (KB)")
+    parser.add_argument("--image-kb", type=int, default=80, help="画像の大きさ (KB)")
+    parser.add_argument("--seed", type=int, default=1, help="遅延・失敗の乱数シード")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較する以前の --json の結果")
+    parser.add_argument("--verbose", action="store_true", help="バッチのログも表示する")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=1)
+        print(f"結果を {args.json} に保存しました。")
+    if args.baseline:
+        compare(results, args.baseline)
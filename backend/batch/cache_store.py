@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+TTL 付きキャッシュモジュール
+- 実行中はメモリ上の LRU キャッシュとして動作 (上限件数を超えたら古いものから破棄)
+- 値が偽 (False / None) のものは「ネガティブ結果」として短い TTL で保持
+- BATCH_CACHE_DB が空でなければ SQLite に永続化し、次回の実行に引き継ぐ
+  (既定は batch/.cache/cache.sqlite3)
+- ヒット / ミス件数を stats() で確認できる
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from state_store import STATE_DIR
+
+CACHE_DB_PATH = os.environ.get("BATCH_CACHE_DB", os.path.join(STATE_DIR, "cache.sqlite3"))
+
+# キャッシュに無いことを示す番兵 (None / False もキャッシュ対象の値なので区別する)
+MISSING = object()
+
+_connections: Dict[str, sqlite3.Connection] = {}
+_db_lock = threading.RLock()
+_caches: List["TTLCache"] = []
+
+
+def _get_connection(db_path: str) -> Optional[sqlite3.Connection]:
+    """SQLite 接続をパスごとに 1 つだけ開いて共有する (失敗したら永続化なし)"""
+    with _db_lock:
+        conn = _connections.get(db_path)
+        if conn is None:
+            try:
+                os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+                conn = sqlite3.connect(db_path, check_same_thread=False)
+                _connections[db_path] = conn
+            except Exception as e:
+                print(f" [キャッシュ] {db_path} を開けません (メモリのみで動作): {e}")
+                return None
+        return conn
+
+
+class TTLCache:
+    """ポジティブ / ネガティブ別 TTL と LRU 上限を持つスレッドセーフなキャッシュ"""
+
+    def __init__(self, name: str, maxsize: int = 10000, ttl: float = 86400,
+                 negative_ttl: float = 3600, db_path: Optional[str] = CACHE_DB_PATH):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, expires_at)
+        self._accessed: Dict[str, float] = {}
+        self._table = f"cache_{''.join(c if c.isalnum() else '_' for c in name)}"
+        self._conn = _get_connection(db_path) if db_path else None
+        if self._conn is not None:
+            try:
+                with _db_lock:
+                    self._conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {self._table} ("
+                        "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)"
+                    )
+            except Exception as e:
+                print(f" [キャッシュ] {name}: テーブルを作成できません (メモリのみで動作): {e}")
+                self._conn = None
+        _caches.append(self)
+
+    # --- 内部 ---
+    def _remember(self, key: str, value: Any, expires_at: float) -> None:
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def _load_from_db(self, key: str, now: float) -> Any:
+        if self._conn is None:
+            return MISSING
+        try:
+            with _db_lock:
+                row = self._conn.execute(
+                    f"SELECT value, expires_at FROM {self._table} WHERE key = ?", (key,)
+                ).fetchone()
+        except Exception:
+            return MISSING
+        if not row or row[1] <= now:
+            return MISSING
+        value = json.loads(row[0])
+        self._remember(key, value, row[1])
+        return value
+
+    # --- 公開API ---
+    def get(self, key: str, default: Any = MISSING) -> Any:
+        """キャッシュ済みの値を返す。無い / 期限切れなら default (既定は MISSING)"""
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] > now:
+                self._items.move_to_end(key)
+                value = item[0]
+            else:
+                if item is not None:
+                    del self._items[key]
+                value = self._load_from_db(key, now)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._accessed[key] = now
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        """値を保存する。偽の値は negative_ttl、それ以外は ttl で期限を設定"""
+        now = time.time()
+        expires_at = now + (self.ttl if value else self.negative_ttl)
+        with self._lock:
+            self._remember(key, value, expires_at)
+            self._accessed[key] = now
+        if self._conn is not None:
+            try:
+                with _db_lock:
+                    self._conn.execute(
+                        f"INSERT OR REPLACE INTO {self._table} (key, value, expires_at, accessed_at) "
+                        "VALUES (?, ?, ?, ?)",
+                        (key, json.dumps(value), expires_at, now),
+                    )
+            except Exception as e:
+                print(f" [キャッシュ] {self.name}: 書き込み失敗: {e}")
+
+    def seed(self, key: str, value: Any) -> None:
+        """
+        値をメモリ上にだけ登録する (SQLite には書かず、永続化済みの値の期限も延ばさない)。
+        DB など別の正本から毎回読み込める値の登録用。メモリに有効な値があるキーは上書きしない
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] > now:
+                return
+            self._remember(key, value, now + (self.ttl if value else self.negative_ttl))
+
+    def flush(self) -> None:
+        """アクセス時刻を書き戻し、期限切れと上限超過分 (最終アクセスが古い順) を削除して確定する"""
+        if self._conn is None:
+            return
+        with self._lock:
+            accessed = list(self._accessed.items())
+            self._accessed.clear()
+        try:
+            with _db_lock:
+                self._conn.executemany(
+                    f"UPDATE {self._table} SET accessed_at = ? WHERE key = ?",
+                    [(ts, key) for key, ts in accessed],
+                )
+                self._conn.execute(f"DELETE FROM {self._table} WHERE expires_at <= ?", (time.time(),))
+                self._conn.execute(
+                    f"DELETE FROM {self._table} WHERE key NOT IN ("
+                    f"SELECT key FROM {self._table} ORDER BY accessed_at DESC LIMIT ?)",
+                    (self.maxsize,),
+                )
+                self._conn.commit()
+        except Exception as e:
+            print(f" [キャッシュ] {self.name}: 保存失敗: {e}")
+
+    def stats(self) -> dict:
+        """ヒット / ミス件数とヒット率を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "name": self.name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "size": len(self._items),
+            }
+
+
+def flush_all_caches() -> None:
+    """生成済みのすべてのキャッシュをディスクに確定する"""
+    for cache in list(_caches):
+        cache.flush()
+
+
+def all_cache_stats() -> List[dict]:
+    """すべてのキャッシュの stats() を返す"""
+    return [cache.stats() for cache in list(_caches)]
+
+
+def print_cache_stats() -> None:
+    """すべてのキャッシュのヒット / ミス件数を表示する"""
+    for cache in list(_caches):
+        s = cache.stats()
+        print(f" [キャッシュ統計] {s['name']}: hit {s['hits']} / miss {s['misses']} (hit率 {s['hit_rate']:.0%})")
@@ -2,17 +2,24 @@
 """
 データベース管理モジュール (Supabase)
 - Supabaseクライアントの初期化
-- 記事データのリストを受け取り、重複を無視してDBに保存 (Upsert)
-- 24時間以上経過した古い記事をDBから削除
+- 記事データのリストを受け取り、重複を無視してDBに保存 (チャンク分割 + 再試行付き Upsert)
+- 保持期間 (RETENTION_HOURS) を過ぎた古い記事をDBからバッチ削除 (任意でファイルへ退避)
+- 保存済み記事の 記事URL → 画像URL を取得 (再スクレイピング回避用)
 """
 
+import json
 import os
-from supabase import create_client, Client
+import time
 from dotenv import load_dotenv
-from typing import Optional, List
+from typing import TYPE_CHECKING, Optional, List
 from datetime import datetime, timedelta, timezone  # ### 追加 ###
 
-def init_supabase_client() -> Optional[Client]:
+from metrics import incr, timed, timer
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+def init_supabase_client() -> Optional["Client"]:
     """
     環境変数を読み込み、Supabaseクライアントを初期化して返す
     """
@@ -21,18 +28,113 @@ def init_supabase_client() -> Optional[Client]:
     SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 
     if SUPABASE_URL and SUPABASE_KEY:
+        # supabase は読み込みが重いため、接続先が設定されているときだけ読み込む
+        from supabase import create_client
         print("Supabaseクライアントを初期化しました。")
         return create_client(SUPABASE_URL, SUPABASE_KEY)
     else:
         print("Supabase未設定: ローカル検証モード（DB保存はスキップ）")
         return None
 
-def save_articles_to_db(supabase_client: Optional[Client], articles: List[dict]) -> int:
+SELECT_PAGE_SIZE = 1000  # PostgREST の既定の最大返却件数に合わせる
+
+
+@timed("db.select_known")
+def fetch_known_article_images(supabase_client: Optional["Client"]) -> dict:
+    """
+    DB に保存済みの記事の { article_url: image_url } を返す。
+    ページングしながら必要な2カラムだけを取得する。
+    """
+    if not supabase_client:
+        return {}
+
+    known = {}
+    start = 0
+    try:
+        while True:
+            response = supabase_client.table("articles").select(
+                "article_url, image_url"
+            ).order("created_at", desc=True).range(start, start + SELECT_PAGE_SIZE - 1).execute()
+            rows = response.data or []
+            for row in rows:
+                if row.get("article_url"):
+                    known[row["article_url"]] = row.get("image_url")
+            if len(rows) < SELECT_PAGE_SIZE:
+                break
+            start += SELECT_PAGE_SIZE
+    except Exception as e:
+        print(f" [Supabase 既存記事の取得エラー]: {e}")
+
+    print(f" [情報] DB上の既存記事 {len(known)} 件の画像URLを取得しました。")
+    return known
+
+
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", "200"))  # 1リクエストあたりの件数
+UPSERT_MAX_RETRIES = 3       # 一時的なエラー時の再試行回数
+UPSERT_RETRY_BACKOFF = 1.0   # 再試行の待ち時間 (秒, 試行ごとに倍増)
+
+
+def _is_transient_error(e: Exception) -> bool:
+    """
+    再試行で回復しうるエラーかどうか
+    PostgreSQL のエラーコード (例: 23505 重複, 22xxx 型不正) を伴うものは再試行しない
+    """
+    code = str(getattr(e, "code", "") or "")
+    if code[:2].isdigit() and not code.startswith(("08", "40", "53", "57")):
+        return False
+    if code.startswith("PGRST"):
+        return False
+    return True
+
+
+@timed("db.upsert_chunk")
+def _upsert_chunk(supabase_client: "Client", chunk: List[dict], return_rows: bool) -> int:
+    """1チャンクを Upsert し、新規挿入件数を返す (一時的なエラーは指数バックオフで再試行)"""
+    for attempt in range(UPSERT_MAX_RETRIES + 1):
+        try:
+            if return_rows:
+                # `returning='representation'` を指定すると、
+                # *新規挿入されたレコード* のみがリストで返されます。
+                response = supabase_client.table("articles").upsert(
+                    chunk,
+                    on_conflict='article_url',    # 重複をチェックするカラム
+                    ignore_duplicates=True,     # 重複したら無視 (DO NOTHING)
+                    returning='representation'  # 新規挿入されたデータだけを返す
+                ).execute()
+                return len(response.data)
+
+            # 件数だけを返してもらい、レスポンスを小さくする
+            response = supabase_client.table("articles").upsert(
+                chunk,
+                on_conflict='article_url',
+                ignore_duplicates=True,
+                returning='minimal',
+                count='exact'
+            ).execute()
+            return response.count or 0
+        except Exception as e:
+            if attempt >= UPSERT_MAX_RETRIES or not _is_transient_error(e):
+                raise
+            wait = UPSERT_RETRY_BACKOFF * (2 ** attempt)
+            print(f" [Supabase Upsert 再試行] {attempt + 1}/{UPSERT_MAX_RETRIES} ({wait:.1f}秒後): {e}")
+            incr("db.upsert_retries")
+            time.sleep(wait)
+    return 0
+
+
+def save_articles_to_db(supabase_client: Optional["Client"], articles: List[dict],
+                        batch_size: int = UPSERT_BATCH_SIZE, return_rows: bool = False,
+                        failed_articles: Optional[List[dict]] = None) -> int:
     """
     記事データのリストを受け取り、DBに Upsert (挿入 or 無視) する。
+    - batch_size 件ずつのチャンクに分けて送信し、失敗したチャンクだけを破棄する
+    - return_rows: True なら挿入された行を返してもらう (False なら件数のみ)
+    - failed_articles: 指定すると、保存できなかった記事 (失敗したチャンク / DB未設定) を追加する
     """
     if not supabase_client:
         print("DBクライアント未設定のため、保存処理をスキップします。")
+        if failed_articles is not None:
+            failed_articles.extend(articles)
         return 0
     
     if not articles:
@@ -45,67 +147,113 @@ def save_articles_to_db(supabase_client: Optional[Client], articles: List[dict])
     # `upsert` を使います。
     # これが 23505 (重複キー) エラーの最も効率的で正しい解決策です。
 
-    print(f"--- {len(articles)} 件の記事候補をDBに一括 Upsert (挿入/無視) します ---")
+    batch_size = max(1, batch_size)
+    chunks = [articles[i:i + batch_size] for i in range(0, len(articles), batch_size)]
+    print(f"--- {len(articles)} 件の記事候補をDBに一括 Upsert (挿入/無視) します ({len(chunks)} チャンク) ---")
     total_inserted = 0
-    try:
-        # `returning='representation'` を指定すると、
-        # *新規挿入されたレコード* のみがリストで返されます。
-        response = supabase_client.table("articles").upsert(
-            articles,
-            on_conflict='article_url',    # 重複をチェックするカラム
-            ignore_duplicates=True,     # 重複したら無視 (DO NOTHING)
-            returning='representation'  # 新規挿入されたデータだけを返す
-        ).execute()
-        
-        total_inserted = len(response.data)
-        
-        if total_inserted > 0:
-            print(f" [Supabase Upsert 成功] {total_inserted} 件の新規記事を挿入しました。")
-        else:
-            print(f" [情報] 新規に挿入された記事はありませんでした。")
-            
-    except Exception as e:
-        print(f" [Supabase一括 Upsert エラー]: {e}")
+    failed_chunks = 0
+    for index, chunk in enumerate(chunks, start=1):
+        try:
+            total_inserted += _upsert_chunk(supabase_client, chunk, return_rows)
+        except Exception as e:
+            failed_chunks += 1
+            incr("db.upsert_failed_chunks")
+            if failed_articles is not None:
+                failed_articles.extend(chunk)
+            print(f" [Supabase一括 Upsert エラー] チャンク {index}/{len(chunks)} ({len(chunk)} 件): {e}")
+
+    incr("db.inserted", total_inserted)
+    if total_inserted > 0:
+        print(f" [Supabase Upsert 成功] {total_inserted} 件の新規記事を挿入しました。")
+    else:
+        print(f" [情報] 新規に挿入された記事はありませんでした。")
+    if failed_chunks:
+        print(f" [警告] {failed_chunks}/{len(chunks)} チャンクの保存に失敗しました。")
             
     return total_inserted
 
 
+# --- 保持期間 (リテンション) の設定 ---
+RETENTION_HOURS = float(os.environ.get("RETENTION_HOURS", "100"))   # この時間より古い記事を削除
+DELETE_BATCH_SIZE = int(os.environ.get("DELETE_BATCH_SIZE", "200"))  # 1回の削除リクエストの件数
+MAX_DELETE_BATCHES = 50  # 1回の実行で処理する最大バッチ数 (残りは次回の実行へ)
+RETENTION_ARCHIVE_PATH = os.environ.get("RETENTION_ARCHIVE_PATH")  # 指定時は削除前に JSONL へ退避
+
+
+def _archive_rows(path: str, rows: List[dict]) -> None:
+    """削除する行を JSON Lines 形式でファイルに追記する"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+
+
 # ### 追加: 古い記事を削除する関数 ###
-def delete_old_articles(supabase_client: Optional[Client]) -> int:
+def delete_old_articles(
+    supabase_client: Optional["Client"],
+    retention_hours: float = RETENTION_HOURS,
+    batch_size: int = DELETE_BATCH_SIZE,
+    max_batches: int = MAX_DELETE_BATCHES,
+    archive_path: Optional[str] = RETENTION_ARCHIVE_PATH,
+) -> int:
     """
-    DB内の古い（24時間以上経過した）記事を削除する
+    DB内の古い（retention_hours 以上経過した）記事を削除する
     スキーマの 'created_at' (TIMESTAMPTZ) を基準にします
+    - created_at 順に batch_size 件ずつ id を取得し、id 指定で削除する
+      (1回の DELETE を小さく保ち、削除した行は返させずに件数だけ受け取る)
+    - archive_path を指定すると、削除前にその行を JSONL ファイルへ追記する
     """
     if not supabase_client:
         print("DBクライアント未設定のため、削除処理をスキップします。")
         return 0
 
-    print("--- 24時間以上経過した古い記事の削除処理を開始します ---")
-    
+    print(f"--- {retention_hours:g}時間以上経過した古い記事の削除処理を開始します ---")
+
+    # カットオフ時刻をUTCで計算 (TIMESTAMPTZはUTC基準のため)
+    cutoff_time = datetime.now(timezone.utc) - timedelta(hours=retention_hours)
+    cutoff_iso = cutoff_time.isoformat()
+    print(f" [情報] 以下の時刻より古い記事 (created_at) を削除します: {cutoff_iso}")
+
+    deleted_count = 0
     try:
-        # 24時間前のカットオフ時刻をUTCで計算 (TIMESTAMPTZはUTC基準のため)
-        cutoff_time = datetime.now(timezone.utc) - timedelta(hours=100)
-        cutoff_iso = cutoff_time.isoformat()
-        
-        print(f" [情報] 以下の時刻より古い記事 (created_at) を削除します: {cutoff_iso}")
-
-        # 'created_at' が cutoff_time より小さい (lt) ものを削除
-        # `returning='representation'` を指定すると、削除されたレコードが返る
-        response = supabase_client.table("articles").delete(
-            returning='representation'
-        ).lt(
-            "created_at", cutoff_iso
-        ).execute()
-        
-        deleted_count = len(response.data)
-        
-        if deleted_count > 0:
-            print(f" [Supabase削除成功] {deleted_count} 件の古い記事を削除しました。")
-        else:
-            print(f" [情報] 削除対象の古い記事はありませんでした。")
-            
-        return deleted_count
+        for _ in range(max_batches):
+            # 'created_at' が cutoff_time より小さい (lt) ものを古い順に batch_size 件
+            with timer("db.delete_select"):
+                response = supabase_client.table("articles").select(
+                    "*" if archive_path else "id"
+                ).lt(
+                    "created_at", cutoff_iso
+                ).order("created_at").limit(batch_size).execute()
+            rows = response.data or []
+            ids = [row["id"] for row in rows if row.get("id") is not None]
+            if not ids:
+                break
+
+            if archive_path:
+                _archive_rows(archive_path, rows)
 
+            with timer("db.delete_batch"):
+                deleted = supabase_client.table("articles").delete(
+                    count='exact',
+                    returning='minimal'
+                ).in_("id", ids).execute()
+            if deleted.count == 0:
+                # 権限などで削除できていない場合に同じ行を取り続けないよう中断
+                print(" [警告] 削除対象の記事を削除できませんでした。処理を中断します。")
+                break
+            deleted_count += deleted.count if deleted.count is not None else len(ids)
+
+            if len(rows) < batch_size:
+                break
+        else:
+            print(f" [情報] 1回の上限 ({max_batches} バッチ) に達しました。残りは次回の実行で削除します。")
     except Exception as e:
         print(f" [Supabase削除エラー]: {e}")
-        return 0
\ No newline at end of file
+
+    incr("db.deleted", deleted_count)
+    if deleted_count > 0:
+        print(f" [Supabase削除成功] {deleted_count} 件の古い記事を削除しました。")
+    else:
+        print(f" [情報] 削除対象の古い記事はありませんでした。")
+
+    return deleted_count
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+ホスト単位の流量制御モジュール
+- トークンバケットでホストごとのリクエスト頻度を制限
+- 連続してタイムアウト / 接続エラー / 5xx になったホストはサーキットブレーカーで遮断し、
+  以後の呼び出しは通信せずに即座に失敗させる (一定時間後に 1 件だけ試行して復帰判定)
+- requests の SESSION (GuardedSession) と http_engine の両方から共有される
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from metrics import incr, timer
+
+# --- 設定 ---
+HOST_RATE_PER_SEC = 5.0        # ホストごとの平均リクエスト数 / 秒
+HOST_BURST = 10                # 一度に使えるトークン数 (バースト)
+BREAKER_FAILURE_THRESHOLD = 3  # 連続失敗がこの回数に達したら遮断
+BREAKER_COOLDOWN = 300.0       # 遮断してから再試行を許すまでの秒数
+
+
+class HostUnavailableError(requests.ConnectionError):
+    """サーキットブレーカーで遮断中のホストへのリクエスト"""
+
+
+class _HostState:
+    def __init__(self, now: float):
+        self.tokens = float(HOST_BURST)
+        self.updated = now
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+
+class HostGuard:
+    """ホストごとのトークンバケットとサーキットブレーカー (スレッドセーフ)"""
+
+    def __init__(self, rate: float = HOST_RATE_PER_SEC, burst: int = HOST_BURST,
+                 failure_threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.rate = rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, _HostState] = {}
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        return (urlsplit(url).hostname or "").lower()
+
+    def _state(self, host: str, now: float) -> _HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState(now)
+            self._hosts[host] = state
+        return state
+
+    def reserve(self, url: str) -> float:
+        """
+        リクエスト 1 件分の枠を確保し、送信前に待つべき秒数を返す。
+        遮断中のホストなら HostUnavailableError を送出する。
+        """
+        host = self.host_of(url)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(host, now)
+            if state.opened_at is not None:
+                if now - state.opened_at < self.cooldown:
+                    self.rejected += 1
+                    incr("http.breaker_rejected", label=host)
+                    raise HostUnavailableError(f"{host} は連続失敗のため一時的に遮断中です")
+                # クールダウン明け: 1 件だけ試行を通し、次の試行は再びクールダウン後 (半開状態)
+                state.opened_at = now
+
+            incr("http.requests", label=host)
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+            state.updated = now
+            state.tokens -= 1
+            return 0.0 if state.tokens >= 0 else -state.tokens / self.rate
+
+    def acquire(self, url: str) -> None:
+        """枠を確保し、必要なら待つ (同期コード用)"""
+        wait = self.reserve(url)
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_success(self, url: str) -> None:
+        with self._lock:
+            state = self._state(self.host_of(url), time.monotonic())
+            state.failures = 0
+            state.opened_at = None
+
+    def record_failure(self, url: str) -> None:
+        """タイムアウト / 接続エラー / 5xx を記録し、閾値に達したら遮断する"""
+        host = self.host_of(url)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(host, now)
+            incr("http.failures", label=host)
+            state.failures += 1
+            if state.failures >= self.failure_threshold:
+                if state.opened_at is None:
+                    print(f" [遮断] {host} で {state.failures} 回連続して失敗したため、{self.cooldown:.0f} 秒間リクエストを止めます")
+                state.opened_at = now
+
+    def open_hosts(self) -> list:
+        """遮断中のホスト一覧"""
+        with self._lock:
+            return sorted(h for h, s in self._hosts.items() if s.opened_at is not None)
+
+
+HOST_GUARD = HostGuard()
+
+
+class GuardedSession(requests.Session):
+    """HOST_GUARD を通してリクエストする requests.Session"""
+
+    def __init__(self, guard: HostGuard = HOST_GUARD):
+        super().__init__()
+        self.guard = guard
+
+    def request(self, method, url, *args, **kwargs):
+        self.guard.acquire(url)
+        try:
+            with timer("http.request"):
+                resp = super().request(method, url, *args, **kwargs)
+        except (requests.Timeout, requests.ConnectionError):
+            self.guard.record_failure(url)
+            raise
+        if resp.status_code >= 500:
+            self.guard.record_failure(url)
+        else:
+            self.guard.record_success(url)
+        return resp
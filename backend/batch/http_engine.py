@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+非同期HTTPエンジン (httpx)
+- httpx.AsyncClient を 1 つだけ作り、全モジュールで接続プールを共有
+- h2 がインストールされていれば HTTP/2 を使用
+- ホストごとの同時リクエスト数の上限と、全体共通のタイムアウト
+- host_guard によるホストごとの流量制限とサーキットブレーカー (requests の SESSION と共有)
+- 専用のイベントループをバックグラウンドスレッドで動かすため、
+  同期コード (各コレクターのスレッド) からも run() で非同期処理を呼び出せる
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Awaitable, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from host_guard import HOST_GUARD, HostGuard
+from metrics import timer
+
+try:
+    import h2  # noqa: F401  (HTTP/2 対応の有無を確認するだけ)
+    HTTP2_AVAILABLE = True
+except Exception:
+    HTTP2_AVAILABLE = False
+
+# --- 設定 ---
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+MAX_CONNECTIONS = 64            # 接続プール全体の上限
+MAX_KEEPALIVE_CONNECTIONS = 32
+MAX_REQUESTS_PER_HOST = 4       # 同一ホストへの同時リクエスト数の上限
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+
+
+class AsyncHttpEngine:
+    """共有の AsyncClient とイベントループを持つHTTPエンジン"""
+
+    def __init__(self, max_requests_per_host: int = MAX_REQUESTS_PER_HOST,
+                 timeout: httpx.Timeout = DEFAULT_TIMEOUT, guard: HostGuard = HOST_GUARD):
+        self.max_requests_per_host = max_requests_per_host
+        self.timeout = timeout
+        self.guard = guard
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    # --- イベントループ ---
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """バックグラウンドのイベントループ (初回アクセス時に起動)"""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="http-engine", daemon=True)
+                thread.start()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    def submit(self, coro: Awaitable) -> Future:
+        """コルーチンをエンジンのループで実行し、concurrent.futures.Future を返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None):
+        """コルーチンをエンジンのループで実行し、結果を待って返す (同期コード用)"""
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("HTTPエンジンのループ内から run() は呼べません (await を使ってください)")
+        return self.submit(coro).result(timeout)
+
+    # --- クライアント ---
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+                headers={"User-Agent": USER_AGENT, "Accept-Language": "ja,en-US;q=0.9,en;q=0.8"},
+            )
+        return self._client
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = (urlsplit(url).hostname or "").lower()
+        sem = self._host_limits.get(host)
+        if sem is None:
+            sem = asyncio.Semaphore(self.max_requests_per_host)
+            self._host_limits[host] = sem
+        return sem
+
+    async def _acquire(self, url: str) -> None:
+        """流量制限の枠を待つ。遮断中のホストなら HostUnavailableError を送出"""
+        wait = self.guard.reserve(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _record(self, url: str, resp: Optional[httpx.Response] = None) -> None:
+        if resp is None or resp.status_code >= 500:
+            self.guard.record_failure(url)
+        else:
+            self.guard.record_success(url)
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """ホストごとの上限を守ってリクエストし、本文まで読み込んだレスポンスを返す"""
+        await self._acquire(url)
+        async with self._host_limit(url):
+            try:
+                with timer("http.request"):
+                    resp = await self._get_client().request(method, url, **kwargs)
+            except httpx.TransportError:
+                self._record(url)
+                raise
+        self._record(url, resp)
+        return resp
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def head(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("HEAD", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """
+        本文を読み込まずにレスポンスを返す (async with で使う。ホストの枠は抜けるまで保持)
+        ホストの成否は抜けるときに記録する (本文の読み込み中のタイムアウト・切断も失敗として数える)
+        """
+        await self._acquire(url)
+        async with self._host_limit(url):
+            try:
+                stream = self._get_client().stream(method, url, **kwargs)
+                with timer("http.request"):  # ヘッダー受信までの時間
+                    resp = await stream.__aenter__()
+            except httpx.TransportError:
+                self._record(url)
+                raise
+            body_failed = False
+            try:
+                yield resp
+            except httpx.TransportError:
+                body_failed = True
+                self._record(url)
+                raise
+            finally:
+                if not body_failed:
+                    self._record(url, resp)
+                await stream.__aexit__(None, None, None)
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def close(self) -> None:
+        """クライアントを閉じてループを停止する"""
+        if self._loop is None:
+            return
+        try:
+            self.run(self.aclose(), timeout=5)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+_engine: Optional[AsyncHttpEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> AsyncHttpEngine:
+    """プロセス共通のHTTPエンジンを返す"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncHttpEngine()
+        return _engine
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+記事の画像補完ステージ
+- コレクターは画像を解決しないままの記事 (生の記事) を返し、ここでまとめて画像を補完する
+- 補完は http_engine のイベントループ上で並列に行い、同時実行数は全コレクターで共有
+- 1 記事あたりの処理時間に上限を設け、遅いサイトで全体が止まらないようにする
+
+コレクターは記事辞書に次のヒントを付けて渡す (補完後は取り除かれ、DB には保存されない)
+- IMAGE_HINT_KEY: API が返した画像URL。有効ならそのまま採用し、無効なら記事ページから探す
+- REQUIRE_IMAGE_KEY: True なら画像が見つからなかった記事を捨てる
+捨てた記事は Checkpoint に伝える (タイムアウト・エラーで捨てた記事は未処理として扱い、次回もう一度見る)
+ソース間で共有する URL の集合 (main の UrlKeySet) を渡すと、他のソースが補完中・保存済みの記事は補完せずに除く
+"""
+
+import asyncio
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Collection, Iterable, Iterator, Optional
+
+from http_engine import get_engine
+from utils import get_main_image_async, validate_image_url_async
+from metrics import incr, timer
+from state_store import Checkpoint
+from url_normalizer import UrlKeySet
+
+# --- 設定 ---
+ENRICH_CONCURRENCY = int(os.environ.get("BATCH_ENRICH_CONCURRENCY", "16"))    # 同時に補完する記事数 (全コレクター共通)
+ENRICH_ARTICLE_TIMEOUT = float(os.environ.get("BATCH_ENRICH_TIMEOUT", "30"))  # 1 記事あたりの補完時間の上限 (秒)
+
+IMAGE_HINT_KEY = "_image_hint"
+REQUIRE_IMAGE_KEY = "_require_image"
+
+_enrich_slots: Optional[asyncio.Semaphore] = None
+
+
+async def _resolve_image_async(article_url: str, hint: Optional[str]) -> Optional[str]:
+    """[内部] ヒントの画像を検証し、無効なら記事ページからメイン画像を探す"""
+    if hint:
+        if await validate_image_url_async(hint):
+            return hint
+        print(f" [提供画像無効] {hint} (記事ページから画像を探します)")
+    return await get_main_image_async(article_url)
+
+
+async def enrich_article_async(article: dict, timeout: float = ENRICH_ARTICLE_TIMEOUT) -> Optional[dict]:
+    """
+    記事の image_url を補完して返す (非同期版)。
+    REQUIRE_IMAGE_KEY 付きで画像が見つからなかった記事は None を返す
+    """
+    global _enrich_slots
+    if _enrich_slots is None:
+        _enrich_slots = asyncio.Semaphore(ENRICH_CONCURRENCY)
+
+    hint = (article.pop(IMAGE_HINT_KEY, None) or "").strip() or None
+    require_image = article.pop(REQUIRE_IMAGE_KEY, False)
+    article_url = article.get("article_url")
+
+    image_url = article.get("image_url")
+    transient = False
+    if not image_url and article_url:
+        # 上限時間は枠を確保してから数える (順番待ちの時間は含めない)
+        async with _enrich_slots:
+            try:
+                with timer("enrich.article"):
+                    image_url = await asyncio.wait_for(_resolve_image_async(article_url, hint), timeout)
+            except asyncio.TimeoutError:
+                print(f" [画像補完タイムアウト] {article_url} ({timeout:g} 秒)")
+                incr("enrich.timeout")
+                image_url = None
+                transient = True
+            except Exception as e:
+                print(f" [画像補完エラー] {article_url} : {e}")
+                incr("enrich.error")
+                image_url = None
+                transient = True
+
+    if not image_url and require_image:
+        print(f" [画像なし] {article.get('title')} は画像が見つからないため除外しました")
+        incr("enrich.dropped")
+        Checkpoint.release(article, ok=not transient)
+        return None
+    article["image_url"] = image_url
+    return article
+
+
+def iter_enriched(articles: Iterable[dict], max_in_flight: int = ENRICH_CONCURRENCY,
+                  timeout: float = ENRICH_ARTICLE_TIMEOUT,
+                  known_urls: Optional[Collection[str]] = None) -> Iterator[dict]:
+    """
+    生の記事を受け取り、画像を補完した記事を完了した順に 1 件ずつ返す (ジェネレーター)。
+    max_in_flight 件まで先読みして並列に補完する
+    - known_urls: ソース間で共有する UrlKeySet (main が全コレクターに渡すもの)。
+      補完を始める記事に処理中の印 (claim) を付け、他のソースが補完中・DB保存済みの記事は補完せずに除く。
+      画像を補完できなかった記事の印は外し、他のソースの同じ記事で改めて補完できるようにする
+    """
+    engine = get_engine()
+    source = iter(articles)
+    claims = known_urls if isinstance(known_urls, UrlKeySet) else None
+    pending = {}  # Future → 元の記事
+    exhausted = False
+
+    def unclaim(article):
+        if claims is not None and article.get("article_url"):
+            claims.discard(article["article_url"])
+
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    article = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                url = article.get("article_url")
+                if claims is not None and url and not claims.claim(url):
+                    # 同じ記事を他のソース (または同じソースの別の項目) が処理している
+                    incr("enrich.duplicates")
+                    Checkpoint.release(article, True)
+                    continue
+                pending[engine.submit(enrich_article_async(article, timeout))] = article
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                article = pending.pop(future)
+                try:
+                    enriched = future.result()
+                except Exception as e:
+                    print(f" [画像補完エラー] {e}")
+                    unclaim(article)
+                    Checkpoint.release(article, ok=False)
+                    continue
+                if enriched is None or not enriched.get("image_url"):
+                    unclaim(article)
+                if enriched is not None:
+                    yield enriched
+    finally:
+        for future, article in pending.items():
+            future.cancel()
+            unclaim(article)
+            Checkpoint.release(article, ok=False)
+        close = getattr(source, "close", None)
+        if close:
+            close()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+画像ヘッダー解析モジュール
+- 先頭数KBのバイト列 (マジックバイト) から画像形式を判定
+- PNG / JPEG / GIF / WebP はヘッダーから幅・高さも取り出す (ファイル全体は不要)
+"""
+
+import struct
+from typing import Optional, Tuple
+
+# (形式, 幅, 高さ)。幅・高さが先頭部分から分からない場合は None
+ImageInfo = Tuple[str, Optional[int], Optional[int]]
+
+# JPEG の SOF (Start Of Frame) マーカー。C4 (DHT), C8 (JPG), CC (DAC) は除く
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _png_size(data: bytes) -> ImageInfo:
+    if len(data) >= 24 and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return "png", width, height
+    return "png", None, None
+
+
+def _gif_size(data: bytes) -> ImageInfo:
+    if len(data) >= 10:
+        width, height = struct.unpack("<HH", data[6:10])
+        return "gif", width, height
+    return "gif", None, None
+
+
+def _webp_size(data: bytes) -> ImageInfo:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return "webp", width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], "little")
+        return "webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X" and len(data) >= 30:
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return "webp", width, height
+    return "webp", None, None
+
+
+def _jpeg_size(data: bytes) -> ImageInfo:
+    i = 2
+    n = len(data)
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:  # パディング
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # 長さを持たないマーカー
+            i += 2
+            continue
+        seg_len = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 9 <= n:
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return "jpeg", width, height
+            break
+        i += 2 + seg_len
+    return "jpeg", None, None
+
+
+def sniff_image(data: bytes) -> Optional[ImageInfo]:
+    """先頭のバイト列から (形式, 幅, 高さ) を返す。画像でなければ None"""
+    if not data:
+        return None
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return _png_size(data)
+    if data.startswith(b"\xff\xd8\xff"):
+        return _jpeg_size(data)
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return _gif_size(data)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _webp_size(data)
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis", b"heic", b"heix", b"mif1"):
+        return "avif" if data[8:11] == b"avi" else "heif", None, None
+    head = data[:512].lstrip().lower()
+    if head.startswith(b"<svg") or (head.startswith(b"<?xml") and b"<svg" in head):
+        return "svg", None, None
+    return None
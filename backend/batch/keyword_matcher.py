@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+キーワード照合モジュール
+- キーワードリストを 1 つの正規表現にまとめてコンパイルし、テキストを 1 回の走査で照合
+- どのキーワードにヒットしたかも返す (スコアリング・タグ付け用)
+"""
+
+import re
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Set, Tuple
+
+
+class KeywordMatcher:
+    """
+    複数キーワードの一括照合器 (大文字小文字は区別しない)
+    各位置で始まる最も長いキーワードを先読み (ゼロ幅) で照合するため、重なり合うキーワード
+    (例: "red panda birth" の "red panda" と "panda birth") もすべて見つかる。
+    ヒットした語に含まれる短いキーワード (例: "giant panda" に含まれる "panda") もヒットとして扱う。
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords: Tuple[str, ...] = tuple(dict.fromkeys(k.lower() for k in keywords if k))
+        ordered = sorted(self.keywords, key=len, reverse=True)
+        self._pattern = re.compile("|".join(re.escape(k) for k in ordered)) if ordered else None
+        # matches() 用: 位置を消費しない先読みで、すべての開始位置を調べる
+        self._overlapping = re.compile(f"(?=({self._pattern.pattern}))") if ordered else None
+        self._implied: Dict[str, FrozenSet[str]] = {
+            k: frozenset(other for other in self.keywords if other in k) for k in self.keywords
+        }
+
+    def search(self, text: str) -> bool:
+        """text (小文字化済み) にいずれかのキーワードが含まれるか"""
+        return bool(text) and self._pattern is not None and self._pattern.search(text) is not None
+
+    def matches(self, text: str) -> Set[str]:
+        """text (小文字化済み) に含まれるキーワードの集合を返す"""
+        if not text or self._pattern is None:
+            return set()
+        found: Set[str] = set()
+        covered_end = 0
+        for m in self._overlapping.finditer(text):
+            keyword = m.group(1)
+            end = m.start() + len(keyword)
+            # 直前にヒットした語の内側に収まる語は、その語の _implied に含まれている
+            if end <= covered_end:
+                continue
+            covered_end = end
+            found |= self._implied[keyword]
+        return found
+
+
+@lru_cache(maxsize=32)
+def _cached_matcher(keywords: Tuple[str, ...]) -> KeywordMatcher:
+    return KeywordMatcher(keywords)
+
+
+def get_keyword_matcher(keywords: Iterable[str]) -> KeywordMatcher:
+    """同じキーワードリストに対しては、コンパイル済みの照合器を使い回す"""
+    return _cached_matcher(tuple(k.lower() for k in keywords if k))
@@ -3,41 +3,257 @@
 Pandas ニュース収集バッチ実行スクリプト (拡張版)
 
 1. 各種コレクターモジュールを呼び出し、記事データを並列で取得
+   (ソースの一覧は source_registry.py。期限・優先度・フィードなどは sources.toml で上書きできる)
    - Google Search API (search_panda_images.py)
    - NewsAPI (article_collector.py)
    - RSS (rss_collector.py)
    - 個別スクレイピング (scrape_collector.py)
-2. DB管理モジュール (database_manager) を呼び出し、取得したデータを保存
+2. DB管理モジュール (database_manager) を呼び出し、取得したデータを
+   収集と並行してマイクロバッチで保存
 3. 古いデータをクリーンアップ
+4. 処理ごとの所要時間・件数を JSON で書き出す (metrics.py)
 """
 
 import os
+import queue
 import sys
+import threading
+import time
+from typing import Callable, Collection, Iterable, List, Optional, Set
+
+# BATCH_IMPORT_REPORT=1 なら、以降のモジュールの読み込み時間を記録する (起動時間の確認用)
+from metrics import (IMPORT_REPORT, METRICS, import_times, incr, print_import_report,
+                     profile_run, profile_thread, timer, trace_imports)
+if IMPORT_REPORT:
+    trace_imports()
+
 from dotenv import load_dotenv
-from typing import List
 
-# --- DB管理モジュール ---
-from database_manager import init_supabase_client, save_articles_to_db, delete_old_articles
+# --- DB管理モジュール (supabase は接続するときに読み込まれる) ---
+from database_manager import init_supabase_client, save_articles_to_db, delete_old_articles, fetch_known_article_images
 
 # --- 共通ヘルパー (単発検証用) ---
-from utils import get_main_image
+from utils import get_main_image, remember_article_images
+from cache_store import all_cache_stats, flush_all_caches, print_cache_stats
+from state_store import CHECKPOINT_KEY, Checkpoint, save_all_state_stores
+from url_normalizer import UrlKeySet, dedupe_articles, url_dedup_key
+from host_guard import HOST_GUARD
+
+# --- 収集ソースのレジストリ (sources.toml。コレクターはソースを動かすときに読み込まれる) ---
+from source_registry import SourceSpec, load_sources
+
+# --- スケジューラ設定 (秒) ---
+# ソースごとの期限と、バッチ全体の収集予算。期限を過ぎたソースは打ち切り、
+# それまでに届いた記事だけで保存処理を続ける。
+SOURCE_TIMEOUT = float(os.environ.get("BATCH_SOURCE_TIMEOUT", "300"))
+BATCH_BUDGET = float(os.environ.get("BATCH_BUDGET", "480"))
+# 同時に動かすソースの数 (0 なら全ソースを同時に開始)。優先度の高い (値の小さい) ソースから開始する
+MAX_PARALLEL_SOURCES = int(os.environ.get("BATCH_MAX_PARALLEL_SOURCES", "0"))
+
+# --- ストリーミング保存の設定 ---
+QUEUE_MAXSIZE = 500          # コレクター → 保存処理 のキューの上限 (メモリ使用量の上限)
+SINK_BATCH_SIZE = 50         # この件数たまったら DB に書き込む
+SINK_FLUSH_INTERVAL = 15.0   # 件数に達しなくても、この秒数ごとに書き込む
+
+
+class _SourceFinished:
+    """[内部] コレクターの終了をキューで通知するためのメッセージ"""
+
+    def __init__(self, count: int, error: Optional[BaseException] = None):
+        self.count = count
+        self.error = error
+
+
+class ArticleSink:
+    """
+    コレクターから届いた記事を受け取り、重複を除いてマイクロバッチで DB に保存する。
+    後段が途中で失敗しても、それまでに書き込んだ記事は失われない。
+    - known_urls: コレクターと共有する UrlKeySet。保存できなかった記事の処理中の印 (claim) は外し、
+      他のソースの同じ記事を改めて処理できるようにする
+    """
+
+    def __init__(self, supabase_client, batch_size: int = SINK_BATCH_SIZE,
+                 flush_interval: float = SINK_FLUSH_INTERVAL, known_urls: Optional[UrlKeySet] = None):
+        self.supabase_client = supabase_client
+        self.known_urls = known_urls
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer: List[dict] = []
+        self.seen_keys: Set[str] = set()
+        self.collected = 0
+        self.unique = 0
+        self.saved = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, article: dict) -> None:
+        self.buffer.append(article)
+        self.collected += 1
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def maybe_flush(self) -> None:
+        if self.buffer and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        pending, self.buffer = self.buffer, []
+        # 収集位置の印 (Checkpoint) は DB に送らず、保存の結果を伝えるために取っておく
+        held = [(url_dedup_key(a.get("article_url") or ""), a.pop(CHECKPOINT_KEY, None)) for a in pending]
+        # ソースをまたいだ重複を正規化URLでまとめる (同じURLが 1 回の Upsert に混ざると失敗するため)
+        batch = dedupe_articles(pending, self.seen_keys)
+        self.unique += len(batch)
+        failed: List[dict] = []
+        if batch:
+            with timer("sink.flush"):
+                self.saved += save_articles_to_db(self.supabase_client, batch, failed_articles=failed)
+        # 保存できなかった記事は、後から届いた同じ記事で再び保存を試みられるようにし、
+        # その記事を返したソースの収集位置を進めない
+        failed_keys = {url_dedup_key(a.get("article_url") or "") for a in failed}
+        self.seen_keys.difference_update(failed_keys)
+        if self.known_urls is not None:
+            for article in failed:
+                self.known_urls.discard(article.get("article_url") or "")
+        for key, checkpoint in held:
+            if checkpoint is not None:
+                checkpoint.settle(key not in failed_keys)
+
+
+def _produce(name: str, make_iter: Callable[[], Iterable[dict]], out: "queue.Queue",
+             stop: threading.Event) -> None:
+    """[コレクタースレッド] 記事を 1 件ずつキューへ送る。stop が立ったら打ち切る"""
+    count = 0
+    error = None
+    started = time.perf_counter()
+    try:
+        with profile_thread():
+            iterator = iter(make_iter())
+            try:
+                for article in iterator:
+                    while not stop.is_set():
+                        try:
+                            out.put((name, article), timeout=0.5)
+                            count += 1
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        break
+            finally:
+                close = getattr(iterator, "close", None)
+                if close:
+                    close()
+    except BaseException as e:
+        error = e
+    METRICS.observe(f"collector.{name}", time.perf_counter() - started)
+    if not stop.is_set():
+        out.put((name, _SourceFinished(count, error)))
+
+
+def run_collectors(
+    sources: List[SourceSpec],
+    sink: ArticleSink,
+    known_urls: Optional[Collection[str]] = None,
+    source_timeout: float = SOURCE_TIMEOUT,
+    batch_budget: float = BATCH_BUDGET,
+    max_parallel: int = MAX_PARALLEL_SOURCES,
+) -> None:
+    """
+    ソースを優先度順に開始して並列に実行し、届いた記事から順に sink へ渡す。
+    - 同時に動かすソースは max_parallel 件まで (0 なら全件)。終わったソースの枠で次のソースを開始する
+    - 期限はソースごと (spec.timeout。未指定なら source_timeout) に開始時刻から数え、
+      バッチ全体の予算 (batch_budget) を超えない。期限を過ぎたソースは打ち切り、それまでに届いた記事は保存する
+    - 収集位置 (High-water mark・ETag など) は、最後まで正常に終わったソースについて、
+      返した記事がすべて保存できた場合だけ確定する (期限切れ・エラーのソースは次回もう一度見る)
+    各コレクターはデーモンスレッドで動かす (期限切れのソースがプロセス終了を引き延ばさないように)。
+    """
+    started = time.monotonic()
+    batch_deadline = started + batch_budget
+    out: "queue.Queue" = queue.Queue(maxsize=QUEUE_MAXSIZE)
+    waiting = list(sources)
+    starts = {}
+    deadlines = {}
+    stops = {}
+    counts = {}
+    checkpoints = {}
+    finished: Set[str] = set()
+    active: Set[str] = set()
+
+    def start_next():
+        while waiting and (max_parallel <= 0 or len(active) < max_parallel):
+            spec = waiting.pop(0)
+            now = time.monotonic()
+            if now >= batch_deadline:
+                print(f"[収集スキップ] {spec.name}: バッチ全体の予算 ({batch_budget:.0f} 秒) を使い切りました")
+                continue
+            stops[spec.name] = threading.Event()
+            starts[spec.name] = now
+            deadlines[spec.name] = min(now + (spec.timeout or source_timeout), batch_deadline)
+            counts[spec.name] = 0
+            checkpoints[spec.name] = Checkpoint(spec.name)
+            active.add(spec.name)
+            make_iter = lambda spec=spec: spec.make_iter(known_urls=known_urls, checkpoint=checkpoints[spec.name])
+            threading.Thread(target=_produce, args=(spec.name, make_iter, out, stops[spec.name]),
+                             name=f"collector-{spec.name}", daemon=True).start()
+
+    def handle(name, item):
+        if isinstance(item, _SourceFinished):
+            active.discard(name)
+            if item.error is not None:
+                incr("collector.errors", label=name)
+                print(f"[収集エラー] {name}: {item.error} ({counts[name]} 件まで保存対象)")
+            else:
+                finished.add(name)
+                print(f"[収集完了] {name}: {counts[name]} 件")
+        else:
+            counts[name] += 1
+            incr("collector.articles", label=name)
+            sink.add(item)
+
+    start_next()
+    while active:
+        now = time.monotonic()
+        for name in [n for n in active if deadlines[n] <= now]:
+            stops[name].set()
+            active.discard(name)
+            incr("collector.timeouts", label=name)
+            print(f"[収集タイムアウト] {name}: 開始から {now - starts[name]:.0f} 秒で打ち切りました ({counts[name]} 件まで保存対象)")
+        start_next()
+        if not active:
+            break
+        wait_for = min(min(deadlines[n] for n in active) - now, sink.flush_interval)
+        try:
+            name, item = out.get(timeout=max(0.05, wait_for))
+        except queue.Empty:
+            sink.maybe_flush()
+            continue
+        handle(name, item)
+        start_next()
+        sink.maybe_flush()
+
+    # 打ち切り前にキューへ届いていた記事も保存対象にする
+    while True:
+        try:
+            name, item = out.get_nowait()
+        except queue.Empty:
+            break
+        handle(name, item)
+    sink.flush()
+
+    # 正常に終わったソースの収集位置を確定する (ファイルへの保存は save_all_state_stores)
+    for name in sorted(finished):
+        checkpoints[name].commit()
+
+    print(f"[収集時間] {time.monotonic() - started:.1f} 秒")
 
-# --- 各種コレクターモジュール ---
-from search_panda_images import fetch_from_google_search
-from article_collector import fetch_from_newsapi
-from rss_collector import fetch_from_rss
 
 def main():
-    # 1. 環境変数の読み込みとDBクライアントの初期化
+    # 1. 環境変数の読み込み
     load_dotenv()
-    supabase_client = init_supabase_client()
-
-    # 2. 必要なAPIキーを環境変数から取得
-    GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-    CUSTOM_SEARCH_CX = os.environ.get("CUSTOM_SEARCH_CX")
-    NEWS_API_KEY = os.environ.get("NEWS_API_KEY")
 
-    # 3. コマンドライン引数がある場合は単発検証モード
+    # 2. コマンドライン引数がある場合は単発検証モード (DB には接続しない)
     #    (utils.py の get_main_image を使うように修正)
     args = sys.argv[1:]
     if args:
@@ -48,65 +264,73 @@ def main():
                 print(f"FOUND image: {img}")
             else:
                 print("NO image found.")
+        flush_all_caches()
+        if IMPORT_REPORT:
+            print_import_report()
         return
 
+    # 3. DBクライアントの初期化
+    supabase_client = init_supabase_client()
+
     # 4. メインのバッチ処理
     print("データ収集バッチ開始 (マルチソース・モード)")
-    
-    all_collected_articles: List[dict] = []
 
-    # --- 4-1. Google Search API から収集 ---
-    if GOOGLE_API_KEY and CUSTOM_SEARCH_CX:
-        try:
-            google_articles = fetch_from_google_search(GOOGLE_API_KEY, CUSTOM_SEARCH_CX)
-            all_collected_articles.extend(google_articles)
-            print(f"[収集完了] Google Search API: {len(google_articles)} 件")
-        except Exception as e:
-            print(f"[収集エラー] Google Search API: {e}")
-    else:
-        print("[収集スキップ] Google APIキーが設定されていません。")
-
-    # --- 4-2. NewsAPI から収集 ---
-    if NEWS_API_KEY:
-        try:
-            newsapi_articles = fetch_from_newsapi(NEWS_API_KEY)
-            all_collected_articles.extend(newsapi_articles)
-            print(f"[収集完了] NewsAPI: {len(newsapi_articles)} 件")
-        except Exception as e:
-            print(f"[収集エラー] NewsAPI: {e}")
-    else:
-        print("[収集スキップ] NewsAPIキーが設定されていません。")
-
-    # --- 4-3. RSSフィード から収集 ---
-    try:
-        rss_articles = fetch_from_rss()
-        all_collected_articles.extend(rss_articles)
-        print(f"[収集完了] RSSフィード: {len(rss_articles)} 件")
-    except Exception as e:
-        print(f"[収集エラー] RSSフィード: {e}")
-
-    # --- 4-4. 個別スクレイピング ---
-    # (注: 現在はサンプル。必要に応じて有効化・拡張してください)
-    # try:
-    #     scraped_articles = fetch_from_scraping()
-    #     all_collected_articles.extend(scraped_articles)
-    #     print(f"[収集完了] 個別スクレイピング: {len(scraped_articles)} 件")
-    # except Exception as e:
-    #     print(f"[収集エラー] 個別スクレイピング: {e}")
-
-
-    print(f"\n--- 全ソースから合計 {len(all_collected_articles)} 件の記事候補を取得しました ---")
-    
-    # 5. データの保存 (変更なし)
-    print("--- データベースへの保存処理を開始します ---")
-    total_saved = save_articles_to_db(supabase_client, all_collected_articles)
+    # 保存済み記事の画像URLをキャッシュに登録し、再スクレイピングを避ける
+    known_articles = fetch_known_article_images(supabase_client)
+    remember_article_images(known_articles)
+    # 収集直後にDB保存済みの記事を除外し、画像の取得・検証は新規記事だけに行う
+    # (正規化したURLで比較するため、utm_* や AMP の違いがあっても既存記事と判定される)
+    # 画像の補完を始めた記事にはここで処理中の印が付き、ソースをまたいだ重複は補完の前に除かれる
+    known_urls = UrlKeySet(known_articles)
+
+    # 収集ソースを設定ファイルから読み込み、必要なAPIキーが揃っているものだけを動かす
+    sources = []
+    for spec in load_sources():
+        missing = spec.missing_env()
+        if missing:
+            print(f"[収集スキップ] {spec.name}: {' / '.join(missing)} が設定されていません。")
+            continue
+        sources.append(spec)
+
+    # 5. ソースを優先度順に並列に実行し、届いた記事からマイクロバッチで保存
+    #    (ソースごとの期限・同時実行数 + バッチ全体の予算)
+    print("--- 収集と並行してデータベースへの保存処理を行います ---")
+    sink = ArticleSink(supabase_client, known_urls=known_urls)
+    with timer("phase.collect"):
+        run_collectors(sources, sink, known_urls)
+    total_saved = sink.saved
+
+    print(f"\n--- 全ソースから合計 {sink.collected} 件の記事候補を取得しました (重複除去後 {sink.unique} 件) ---")
 
     # 6. 古いデータの削除 (変更なし)
     print("--- 古い記事のクリーンアップ処理を開始します ---")
-    total_deleted = delete_old_articles(supabase_client)
+    with timer("phase.cleanup"):
+        total_deleted = delete_old_articles(supabase_client)
+
+    # 7. キャッシュと収集位置 (High-water mark) の確定、統計表示
+    #    (収集位置は記事を保存し終えてからディスクに書き出す)
+    flush_all_caches()
+    save_all_state_stores()
+    print_cache_stats()
+    if HOST_GUARD.open_hosts():
+        print(f" [遮断ホスト] {', '.join(HOST_GUARD.open_hosts())} (遮断により省略したリクエスト: {HOST_GUARD.rejected} 件)")
+
+    # 8. 計測結果 (処理ごとの所要時間・件数、ホスト別リクエスト数) を書き出す
+    METRICS.print_slowest()
+    if IMPORT_REPORT:
+        print_import_report()
+    METRICS.write_summary(extra={
+        "articles": {"collected": sink.collected, "unique": sink.unique, "saved": total_saved,
+                     "deleted": total_deleted},
+        "caches": all_cache_stats(),
+        "open_hosts": HOST_GUARD.open_hosts(),
+        "imports": import_times() if IMPORT_REPORT else [],
+    })
 
     print(f"\nデータ収集バッチ完了 (新規保存: {total_saved} 件, 削除: {total_deleted} 件)")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # BATCH_PROFILE=cprofile / pyinstrument でプロファイルも保存する (metrics.py)
+    with profile_run():
+        main()
\ No newline at end of file
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+計測モジュール (タイマー / カウンター / ヒストグラム)
+- 各処理の所要時間と件数を記録し、実行の最後に JSON のサマリーとして書き出す
+  (出力先は BATCH_METRICS_PATH。未設定なら batch/.cache/metrics.json、空文字なら書き出さない)
+- BATCH_PROFILE=cprofile / pyinstrument を指定すると、バッチ全体のプロファイルも保存する
+  (出力先は BATCH_PROFILE_PATH。未設定なら batch/.cache/profile.prof / profile.html)
+- BATCH_IMPORT_REPORT=1 を指定すると、モジュールの読み込み時間 (python -X importtime 相当) を表示する
+- スレッドセーフ。同期関数・非同期関数のどちらにも timed() を付けられる
+"""
+
+import asyncio
+import builtins
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from state_store import STATE_DIR
+
+METRICS_PATH = os.environ.get("BATCH_METRICS_PATH", os.path.join(STATE_DIR, "metrics.json"))
+PROFILE_MODE = (os.environ.get("BATCH_PROFILE") or "").strip().lower()
+PROFILE_PATH = os.environ.get("BATCH_PROFILE_PATH")
+IMPORT_REPORT = os.environ.get("BATCH_IMPORT_REPORT", "").strip().lower() in ("1", "true", "yes")
+HISTOGRAM_SAMPLE_SIZE = 2000  # パーセンタイル計算のために保持する値の最大数 (リザーバーサンプリング)
+
+
+class Histogram:
+    """値の件数・合計・最小・最大と、パーセンタイル用のサンプルを保持する"""
+
+    def __init__(self, sample_size: int = HISTOGRAM_SAMPLE_SIZE):
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self._samples: List[float] = []
+        self._sample_size = sample_size
+        self._random = random.Random(0)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._samples) < self._sample_size:
+            self._samples.append(value)
+        else:
+            index = self._random.randrange(self.count)
+            if index < self._sample_size:
+                self._samples[index] = value
+
+    def percentile(self, pct: float) -> float:
+        if not self._samples:
+            return 0.0
+        values = sorted(self._samples)
+        return values[min(len(values) - 1, int(pct / 100.0 * len(values)))]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total": round(self.total, 4),
+            "mean": round(self.total / self.count, 4) if self.count else 0.0,
+            "min": round(self.min or 0.0, 4),
+            "p50": round(self.percentile(50), 4),
+            "p90": round(self.percentile(90), 4),
+            "p99": round(self.percentile(99), 4),
+            "max": round(self.max or 0.0, 4),
+        }
+
+
+class Metrics:
+    """名前付きのカウンターとヒストグラムの集合 (タイマーは秒単位のヒストグラム)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Any] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.started_at = time.time()
+
+    def incr(self, name: str, value: int = 1, label: Optional[str] = None) -> None:
+        """カウンターを加算する。label を付けると name の下にラベルごとに集計する (例: ホスト別)"""
+        with self._lock:
+            if label is None:
+                self.counters[name] = self.counters.get(name, 0) + value
+            else:
+                labeled = self.counters.setdefault(name, {})
+                labeled[label] = labeled.get(label, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        """ヒストグラムに値を記録する"""
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """with ブロックの所要時間 (秒) を name のヒストグラムに記録する (例外時も記録)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name: str):
+        """関数の所要時間を記録するデコレーター (async def にも使える)"""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self, extra: Optional[dict] = None) -> dict:
+        with self._lock:
+            result = {
+                "started_at": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+                "elapsed_seconds": round(time.time() - self.started_at, 3),
+                "counters": json.loads(json.dumps(self.counters)),
+                "timers": {name: hist.summary() for name, hist in sorted(self.histograms.items())},
+            }
+        if extra:
+            result.update(extra)
+        return result
+
+    def write_summary(self, path: Optional[str] = METRICS_PATH, extra: Optional[dict] = None) -> Optional[dict]:
+        """サマリーを JSON ファイルに書き出して返す (path が空なら書き出さない)"""
+        summary = self.summary(extra)
+        if not path:
+            return summary
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=1, sort_keys=True)
+            print(f" [計測] 実行サマリーを {path} に書き出しました。")
+        except Exception as e:
+            print(f" [計測] サマリーを書き出せませんでした: {e}")
+        return summary
+
+    def print_slowest(self, limit: int = 10) -> None:
+        """合計時間の長い処理を表示する"""
+        with self._lock:
+            items = sorted(self.histograms.items(), key=lambda kv: kv[1].total, reverse=True)[:limit]
+            lines = [(name, hist.count, hist.total, hist.percentile(90)) for name, hist in items]
+        for name, count, total, p90 in lines:
+            print(f" [計測] {name}: 合計 {total:.2f} 秒 / {count} 回 (p90 {p90 * 1000:.0f}ms)")
+
+
+METRICS = Metrics()
+
+# モジュール関数として使う (from metrics import timer, incr)
+incr = METRICS.incr
+observe = METRICS.observe
+timer = METRICS.timer
+timed = METRICS.timed
+
+
+_thread_profiles: list = []
+_thread_profiles_lock = threading.Lock()
+_profiling = False
+
+
+@contextmanager
+def profile_thread():
+    """
+    cProfile で profile_run 中なら、このスレッドの処理もプロファイルに含める
+    (コレクターのスレッドで使う。HTTPエンジンのループは対象外なので、通信側は各タイマーを参照)
+    """
+    if not _profiling:
+        yield
+        return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _thread_profiles_lock:
+            _thread_profiles.append(profiler)
+
+
+@contextmanager
+def profile_run(mode: str = PROFILE_MODE, path: Optional[str] = PROFILE_PATH):
+    """
+    mode ("cprofile" / "pyinstrument") を指定した場合だけ with ブロックをプロファイルして保存する。
+    pyinstrument が無ければ cProfile で代用する (pyinstrument は呼び出したスレッドのみ)
+    """
+    if not mode:
+        yield
+        return
+
+    if mode == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except Exception:
+            print(" [計測] pyinstrument が見つからないため cProfile を使います。")
+            mode = "cprofile"
+        else:
+            out = path or os.path.join(STATE_DIR, "profile.html")
+            profiler = Profiler(async_mode="disabled")
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+                with open(out, "w", encoding="utf-8") as f:
+                    f.write(profiler.output_html())
+                print(f" [計測] プロファイルを {out} に保存しました。")
+            return
+
+    import cProfile
+    import pstats
+    global _profiling
+    out = path or os.path.join(STATE_DIR, "profile.prof")
+    profiler = cProfile.Profile()
+    _profiling = True
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiling = False
+        # メインスレッドと、終了したコレクタースレッドのプロファイルをまとめて保存する
+        stats = pstats.Stats(profiler)
+        with _thread_profiles_lock:
+            for thread_profiler in _thread_profiles:
+                stats.add(thread_profiler)
+            _thread_profiles.clear()
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        stats.dump_stats(out)
+        print(f" [計測] プロファイルを {out} に保存しました (python -m pstats {out} で確認)。")
+
+
+# --- モジュールの読み込み時間 (python -X importtime 相当) ---
+_import_times: List[tuple] = []  # 読み込みが終わった順の (深さ, モジュール名, 自身の時間, 累積時間)
+_import_state = threading.local()
+_original_import = builtins.__import__
+
+
+def _tracing_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """[内部] 初めて読み込まれる絶対インポートの所要時間を記録する __import__"""
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    stack = getattr(_import_state, "stack", None)
+    if stack is None:
+        stack = _import_state.stack = []
+    stack.append(0.0)  # 子モジュールの読み込み時間の合計
+    started = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - started
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        _import_times.append((len(stack), name, elapsed - children, elapsed))
+
+
+def trace_imports() -> None:
+    """以降に初めて読み込まれるモジュールの所要時間を記録する (print_import_report で表示)"""
+    if builtins.__import__ is not _tracing_import:
+        builtins.__import__ = _tracing_import
+
+
+def import_times(limit: int = 20) -> List[dict]:
+    """記録したモジュールを累積時間の長い順に返す"""
+    items = sorted(_import_times, key=lambda t: t[3], reverse=True)[:limit]
+    return [{"module": name, "self": round(self_time, 4), "cumulative": round(total, 4)}
+            for _, name, self_time, total in items]
+
+
+def print_import_report(limit: int = 20) -> None:
+    """累積時間の長いモジュールを -X importtime と同じ書式 (マイクロ秒、読み込みが終わった順) で表示する"""
+    if not _import_times:
+        return
+    top = {item["module"] for item in import_times(limit)}
+    print(" [計測] モジュールの読み込み時間 (self [us] | cumulative [us] | module)")
+    for depth, name, self_time, total in _import_times:
+        if name in top:
+            print(f"  {self_time * 1e6:10.0f} | {total * 1e6:10.0f} | {'  ' * depth}{name}")
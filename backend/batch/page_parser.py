@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+HTML / フィードのパース処理
+- 記事ページからの画像候補・canonical URL の抽出、HTML内の RSS リンクの発見、フィードのパース
+- 通信やキャッシュに依存しない純粋な関数だけを置く (parse_pool の別プロセスでも動かすため)
+- 戻り値は別プロセスから受け渡しできる小さな値 (リスト・辞書・文字列) にする
+"""
+
+import json
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from urllib.parse import urljoin
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+MAX_BODY_IMAGE_CANDIDATES = 8  # 本文中 <img> から検証する候補の最大数
+
+# HTML パーサー (lxml があれば高速な lxml を使う)
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except Exception:
+    HTML_PARSER = "html.parser"
+
+
+def parse_html(content, parser: str = HTML_PARSER) -> "BeautifulSoup":
+    """HTML をパースする (bs4 は起動を軽くするため、最初にパースするときに読み込む)"""
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, parser)
+
+
+def collect_image_candidates(final_url: str, soup: "BeautifulSoup", include_body: bool = True) -> List[str]:
+    """
+    ページ内の画像候補を優先度順 (OGP → JSON-LD → 本文) に重複なしで集める
+    include_body=False なら本文中 <img> は集めない (<head> だけをパースした場合)
+    """
+    candidates: List[str] = []
+
+    def add(raw):
+        if not isinstance(raw, str) or not raw.strip() or raw.startswith("data:"):
+            return
+        cand = urljoin(final_url, raw.strip())
+        if cand not in candidates:
+            candidates.append(cand)
+
+    # 1) OGP / Twitter
+    meta_keys = [
+        ("meta", {"property": "og:image"}, "content"),
+        ("meta", {"property": "og:image:secure_url"}, "content"),
+        ("meta", {"name": "twitter:image"}, "content"),
+    ]
+    for tag, attrs, attrname in meta_keys:
+        t = soup.find(tag, attrs=attrs)
+        if t and t.get(attrname):
+            add(t.get(attrname))
+
+    # 2) JSON-LD
+    for script in soup.find_all("script", type="application/ld+json"):
+        try:
+            txt = script.string
+            if not txt: continue
+            data = json.loads(txt)
+            items = data if isinstance(data, list) else [data]
+            for it in items:
+                if isinstance(it, dict):
+                    img = it.get("image") or it.get("thumbnailUrl")
+                    if isinstance(img, str):
+                        add(img)
+                    elif isinstance(img, dict):
+                        add(img.get("url"))
+                    elif isinstance(img, list):
+                        for it2 in img:
+                            add(it2)
+        except Exception:
+            continue
+
+    if not include_body:
+        return candidates
+
+    # 3) 本文中画像
+    selectors = ["article", "main", "[role='main']", ".post-content", ".article-body", "#content"]
+    main_content = None
+    for s in selectors:
+        main_content = soup.select_one(s)
+        if main_content: break
+    if not main_content:
+        main_content = soup.body
+
+    if main_content:
+        body_count = 0
+        for img in main_content.find_all("img", src=True):
+            if body_count >= MAX_BODY_IMAGE_CANDIDATES: break
+            before = len(candidates)
+            add(img.get("src"))
+            body_count += len(candidates) - before
+    return candidates
+
+
+def extract_page_info(final_url: str, content: bytes, include_body: bool = True) -> Tuple[List[str], Optional[str]]:
+    """HTML (または <head> 部分) をパースし、(画像候補リスト, canonical URL) を返す"""
+    soup = parse_html(content)
+    canonical = soup.find("link", rel="canonical", href=True)
+    canonical_url = urljoin(final_url, canonical["href"]) if canonical else None
+    return collect_image_candidates(final_url, soup, include_body), canonical_url
+
+
+def discover_feed_link(base_url: str, html_text: str) -> Optional[str]:
+    """HTML内からRSSリンクを発見して絶対URLとして返す（見つからなければ None）"""
+    try:
+        soup = parse_html(html_text, "html.parser")
+        # <link rel="alternate" type="application/rss+xml" href="...">
+        link = soup.find("link", rel=lambda x: x and "alternate" in x.lower(),
+                         type=lambda t: t and "rss" in t.lower())
+        if link and link.get("href"):
+            return urljoin(base_url, link["href"])
+        # <a> にフィードや RSS の文言がある場合
+        a = soup.find("a", href=True, string=lambda s: s and "rss" in s.lower())
+        if a:
+            return urljoin(base_url, a["href"])
+    except Exception:
+        pass
+    return None
+
+
+# フィードの各エントリーから残す項目 (キーワード照合・記事辞書の作成に使うものだけ)
+FEED_ENTRY_FIELDS = ("id", "link", "title", "summary", "description",
+                     "published", "updated", "published_parsed", "updated_parsed")
+
+
+def _compact_entry(entry, content_limit: int) -> dict:
+    """[内部] feedparser のエントリーを必要な項目だけの辞書にする (content は content_limit 文字まで)"""
+    compact = {key: entry.get(key) for key in FEED_ENTRY_FIELDS if entry.get(key) is not None}
+    if "tags" in entry:
+        compact["tags"] = [
+            {"term": t.get("term") or "", "label": t.get("label") or ""} if isinstance(t, dict) else str(t)
+            for t in entry.get("tags") or []
+        ]
+    if "content" in entry:
+        content = entry.get("content")
+        if isinstance(content, (dict, str)):
+            content = [content]
+        values, remaining = [], content_limit
+        for ci in content if isinstance(content, list) else []:
+            if remaining <= 0:
+                break
+            value = ((ci.get("value") if isinstance(ci, dict) else str(ci)) or "")[:remaining]
+            remaining -= len(value)
+            values.append({"value": value})
+        compact["content"] = values
+    return compact
+
+
+def parse_feed(content: bytes, content_limit: int = 20000) -> dict:
+    """
+    フィード (RSS / Atom) のバイト列をパースし、次の項目だけを持つ辞書を返す
+    {"title": フィード名, "bozo": 形式の誤りがあったか, "entries": [エントリーの辞書, ...]}
+    """
+    import feedparser  # 起動を軽くするため、最初にフィードを解析するときに読み込む
+    feed = feedparser.parse(content)
+    return {
+        "title": feed.feed.get("title"),
+        "bozo": bool(getattr(feed, "bozo", False)),
+        "entries": [_compact_entry(entry, content_limit) for entry in feed.entries or []],
+    }
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+パース処理のプロセスプール (任意)
+- feedparser / BeautifulSoup のパースは純 Python の CPU 処理で、スレッドを増やしても GIL で直列になる
+- BATCH_PARSE_PROCESSES を指定すると、パースを別プロセスで並列に行う
+  ("auto" なら使える CPU コア数。未設定 / 0 なら従来どおり呼び出し元のスレッドでパースする)
+- ワーカーには生のバイト列を渡し、page_parser の関数が返す小さな結果 (候補URL・エントリーの辞書) を受け取る
+- プロセスが異常終了した場合は、以後のパースを呼び出し元のスレッドで行う
+"""
+
+import asyncio
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, TypeVar
+
+from metrics import incr
+
+T = TypeVar("T")
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 1
+
+
+def _parse_processes(value: str) -> int:
+    value = (value or "").strip().lower()
+    if value == "auto":
+        return _available_cores()
+    try:
+        return max(0, int(value or "0"))
+    except ValueError:
+        print(f" [パース] BATCH_PARSE_PROCESSES の値が不正です ({value})。別プロセスは使いません。")
+        return 0
+
+
+PARSE_PROCESSES = _parse_processes(os.environ.get("BATCH_PARSE_PROCESSES", ""))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_pool_broken = False
+
+
+def get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """プロセスプールを返す (無効な場合は None)。最初に使うときに作る"""
+    global _pool
+    if PARSE_PROCESSES <= 0 or _pool_broken:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # コレクターや HTTP エンジンのスレッドが動いているため fork ではなく spawn で起動する
+            _pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                        mp_context=multiprocessing.get_context("spawn"))
+            print(f" [パース] {PARSE_PROCESSES} プロセスでパースします。")
+        return _pool
+
+
+def _disable_pool(error: BaseException) -> None:
+    """[内部] 壊れたプールを捨て、以後は呼び出し元のスレッドでパースする"""
+    global _pool_broken
+    if not _pool_broken:
+        _pool_broken = True
+        print(f" [パース] 別プロセスでのパースに失敗したため、以後はスレッドでパースします: {error}")
+    incr("parse.pool_broken")
+
+
+def run_parse(func: Callable[..., T], *args) -> T:
+    """func(*args) をプロセスプールで実行して結果を返す (プールが無効なら、このスレッドで実行する)"""
+    pool = get_parse_pool()
+    if pool is not None:
+        try:
+            return pool.submit(func, *args).result()
+        except BrokenProcessPool as e:
+            _disable_pool(e)
+    return func(*args)
+
+
+async def run_parse_async(func: Callable[..., T], *args) -> T:
+    """run_parse の非同期版 (プールが無効なら、イベントループを止めないよう既定のスレッドプールで実行する)"""
+    loop = asyncio.get_running_loop()
+    pool = get_parse_pool()
+    if pool is not None:
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool as e:
+            _disable_pool(e)
+    return await loop.run_in_executor(None, func, *args)
+
+
+def shutdown_parse_pool() -> None:
+    """プロセスプールを終了する (atexit でも呼ばれる)"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown_parse_pool)
@@ -2,24 +2,39 @@
 """
 記事データ収集モジュール (RSS)
 - 指定されたRSSフィードを巡回
-- 記事の画像は utils.py の get_main_image で補完（任意）
+- 記事の画像は image_enricher で補完（任意）
 """
 
-from typing import List, Optional
-import feedparser
-import requests
-from urllib.parse import urlparse, urljoin
-from bs4 import BeautifulSoup
+from typing import Collection, Dict, Iterator, List, Optional, Set
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import html
 
 # 共通ヘルパーをインポート（ユーザ実装前提）
-from utils import get_main_image, parse_published
+from utils import parse_published, SESSION
+from page_parser import discover_feed_link, parse_feed
+from parse_pool import run_parse
+from image_enricher import ENRICH_CONCURRENCY, iter_enriched
+from state_store import Checkpoint, HighWaterMark, get_state_store, iter_committing
+from url_normalizer import UrlKeySet
+from keyword_matcher import KeywordMatcher, get_keyword_matcher
+from metrics import incr, timer, timed
 
 # --- 設定 ---
 REQUEST_TIMEOUT = 10.0
 USER_AGENT = "Mozilla/5.0 (compatible; MyRSSBot/1.0; +https://example.com/bot)"
+MAX_FEED_WORKERS = 8              # フィード取得の並列数
+MAX_CONNECTIONS_PER_HOST = 2      # 同一ホストへの同時接続数の上限
+CONTENT_SCAN_LIMIT = 20000       # キーワード照合で content 本文を走査する最大文字数
+FEED_STATE_STORE = "feed_http_cache"  # ETag / Last-Modified の保存先 (state_store)
+
+# 条件付き GET で 304 (未更新) が返ったことを示す番兵
+NOT_MODIFIED = object()
 
 # 実稼働で安定して取得できたフィード（ログ確認済み）
+# (フィード一覧はここだけに定義する。sources.toml の options.feeds を書いた場合はそちらで上書き)
 RSS_FEEDS = [
     # --- 日本 国内（ログで entries>0 確認） ---
     "https://www3.nhk.or.jp/rss/news/cat0.xml",        # NHK 総合（OK）
@@ -47,7 +62,7 @@ RSS_FEEDS = [
 ]
 
 
-# --- デフォルトキーワード（小文字で比較） ---
+# --- デフォルトキーワード（小文字で比較。sources.toml の options.keywords で変更可） ---
 DEFAULT_KEYWORDS = [
     # 英語
     "panda", "pandas", "giant panda", "red panda",
@@ -66,51 +81,76 @@ DEFAULT_KEYWORDS_LOWER = [k.lower() for k in DEFAULT_KEYWORDS]
 # -----------------------
 # 内部ヘルパー
 # -----------------------
-def _discover_rss_link_from_html(base_url: str, html_text: str) -> Optional[str]:
-    """HTML内からRSSリンクを発見して絶対URLとして返す（見つからなければ None）"""
-    try:
-        soup = BeautifulSoup(html_text, "html.parser")
-        # <link rel="alternate" type="application/rss+xml" href="...">
-        link = soup.find("link", rel=lambda x: x and "alternate" in x.lower(),
-                         type=lambda t: t and "rss" in t.lower())
-        if link and link.get("href"):
-            return urljoin(base_url, link["href"])
-        # <a> にフィードや RSS の文言がある場合
-        a = soup.find("a", href=True, string=lambda s: s and "rss" in s.lower())
-        if a:
-            return urljoin(base_url, a["href"])
-    except Exception:
-        pass
-    return None
-
-
-def _get_feed_via_requests(url: str, user_agent: str, timeout: float, verify_ssl: bool):
-    """requests で取得して feedparser に渡す。HTMLなら RSS 発見を試みる"""
+def _conditional_headers(url: str) -> dict:
+    """前回取得時の ETag / Last-Modified から条件付き GET 用ヘッダーを作る"""
+    cached = get_state_store(FEED_STATE_STORE).get(url) or {}
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+def _response_validators(resp) -> dict:
+    """レスポンスの ETag / Last-Modified を取り出す (記録はフィードの記事を保存してから行う)"""
+    return {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+
+
+def _remember_validators(url: str, validators: dict) -> None:
+    """ETag / Last-Modified を次回の条件付き GET 用に記録する"""
+    store = get_state_store(FEED_STATE_STORE)
+    if validators.get("etag") or validators.get("last_modified"):
+        store.set(url, validators)
+    else:
+        store.delete(url)
+
+
+def _get_feed_via_requests(url: str, user_agent: str, timeout: float, verify_ssl: bool,
+                           conditional: bool = True):
+    """
+    requests (utils の共有 SESSION) で取得して page_parser.parse_feed でパースする。HTMLなら RSS 発見を試みる
+    戻り値の feed は parse_feed が返す辞書 ({"title", "bozo", "entries"})
+    - conditional: True なら前回の ETag / Last-Modified で条件付き GET を行い、
+      304 の場合はパースせずに (None, NOT_MODIFIED) を返す。
+      今回の ETag / Last-Modified は feed["validators"] に入れて返す (ここでは記録しない)
+    """
     headers = {"User-Agent": user_agent}
+    if conditional:
+        headers.update(_conditional_headers(url))
     try:
-        resp = requests.get(url, headers=headers, timeout=timeout, allow_redirects=True, verify=verify_ssl)
+        resp = SESSION.get(url, headers=headers, timeout=timeout, allow_redirects=True, verify=verify_ssl)
     except Exception as e:
         print(f"  [HTTP ERROR] {url} を取得できません: {e}")
         return None, getattr(e, "__class__", Exception)
 
     status = getattr(resp, "status_code", None)
     print(f"  [HTTP] {url} -> status {status}")
-    feed = feedparser.parse(resp.content)
-    print(f"    feed.status: {getattr(feed,'status','N/A')}, entries: {len(feed.entries)}, bozo: {getattr(feed,'bozo',False)}")
-    if len(feed.entries) > 0:
+    if status == 304:
+        return None, NOT_MODIFIED
+    # パースは parse_pool (BATCH_PARSE_PROCESSES 指定時は別プロセス) で行い、必要な項目だけを受け取る
+    with timer("rss.feedparser_parse"):
+        feed = run_parse(parse_feed, resp.content, CONTENT_SCAN_LIMIT)
+    print(f"    entries: {len(feed['entries'])}, bozo: {feed['bozo']}")
+    if len(feed["entries"]) > 0:
+        # 正常にパースできたときだけ記録の対象にする (壊れた応答で以後ずっと 304 にならないように)
+        if conditional:
+            feed["validators"] = _response_validators(resp)
         return feed, None
 
-    # HTML の場合はページ内に RSS リンクが無いか探す
+    # HTML の場合はページ内に RSS リンクが無いか探す (発見先には条件付きヘッダーを送らない)
+    headers = {"User-Agent": user_agent}
     content_type = resp.headers.get("Content-Type", "")
     if "html" in content_type or len(resp.content) > 0:
-        discovered = _discover_rss_link_from_html(resp.url, resp.text)
+        discovered = run_parse(discover_feed_link, resp.url, resp.text)
         if discovered and discovered != url:
             print(f"    [DISCOVER] HTML内にRSSリンクを発見: {discovered} — 再取得します")
             try:
-                r2 = requests.get(discovered, headers=headers, timeout=timeout, allow_redirects=True, verify=verify_ssl)
-                f2 = feedparser.parse(r2.content)
-                print(f"      discovered feed.status: {getattr(f2,'status','N/A')}, entries: {len(f2.entries)}, bozo: {getattr(f2,'bozo',False)}")
-                if len(f2.entries) > 0:
+                r2 = SESSION.get(discovered, headers=headers, timeout=timeout, allow_redirects=True, verify=verify_ssl)
+                with timer("rss.feedparser_parse"):
+                    f2 = run_parse(parse_feed, r2.content, CONTENT_SCAN_LIMIT)
+                print(f"      discovered entries: {len(f2['entries'])}, bozo: {f2['bozo']}")
+                if len(f2["entries"]) > 0:
                     return f2, None
             except Exception as e:
                 print(f"      [ERROR] 発見したRSSの取得失敗: {e}")
@@ -118,25 +158,59 @@ def _get_feed_via_requests(url: str, user_agent: str, timeout: float, verify_ssl
     return None, None
 
 
-def _entry_combined_text(entry) -> str:
-    """entry の title/summary/content/tags を結合して小文字化した文字列を返す"""
-    parts: List[str] = []
-    parts.append(entry.get("title") or "")
-    parts.append(entry.get("summary") or entry.get("description") or "")
+_host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_host_semaphores_lock = threading.Lock()
 
-    content_text = ""
-    if "content" in entry:
+
+def _host_semaphore(url: str) -> threading.BoundedSemaphore:
+    """ホストごとの同時接続数を制限するセマフォを返す"""
+    host = urlparse(url).netloc.lower()
+    with _host_semaphores_lock:
+        sem = _host_semaphores.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+            _host_semaphores[host] = sem
+        return sem
+
+
+@timed("rss.fetch_feed")
+def _fetch_feed(url: str, user_agent: str, timeout: float, verify_ssl: bool, conditional: bool):
+    """[ワーカー] ホスト単位の同時接続数を守りつつ 1 フィードを取得・パースする"""
+    with _host_semaphore(url):
+        print(f"[RSS] {url} を巡回中...")
         try:
-            c = entry["content"]
-            if isinstance(c, list):
-                content_text = " ".join([(ci.get("value") if isinstance(ci, dict) else str(ci)) or "" for ci in c])
-            elif isinstance(c, dict):
-                content_text = c.get("value", "") or ""
-            elif isinstance(c, str):
-                content_text = c
-        except Exception:
-            content_text = ""
-    parts.append(content_text)
+            return _get_feed_via_requests(url, user_agent, timeout, verify_ssl, conditional)
+        except Exception as e:
+            return None, e
+
+
+def _iter_feeds_concurrently(urls: List[str], user_agent: str, timeout: float, verify_ssl: bool,
+                             max_workers: int = MAX_FEED_WORKERS, conditional: bool = True) -> Iterator[tuple]:
+    """
+    複数フィードを並列に取得し、(url, feed, error) を urls と同じ順序で逐次返す。
+    完了順ではなく入力順で返すため、後段の処理結果は毎回同じ順序になる。
+    途中で打ち切られた場合、未着手の取得は取り消す。
+    """
+    if not urls:
+        return
+    workers = max(1, min(max_workers, len(urls)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rss")
+    try:
+        futures = [executor.submit(_fetch_feed, u, user_agent, timeout, verify_ssl, conditional) for u in urls]
+        for u, f in zip(urls, futures):
+            yield (u, *f.result())
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _entry_text_fields(entry, content_limit: int = CONTENT_SCAN_LIMIT) -> Iterator[str]:
+    """
+    entry のテキストを照合に使う順 (title → summary → tags → content) に 1 つずつ返す。
+    生成は遅延評価なので、手前のフィールドでヒットすれば大きな content は展開しない。
+    content は合計 content_limit 文字までに切り詰める。
+    """
+    yield entry.get("title") or ""
+    yield entry.get("summary") or entry.get("description") or ""
 
     if "tags" in entry:
         try:
@@ -146,107 +220,226 @@ def _entry_combined_text(entry) -> str:
                     tag_texts.append(t.get("term", "") or t.get("label", "") or "")
                 elif isinstance(t, str):
                     tag_texts.append(t)
-            parts.append(" ".join(tag_texts))
+            yield " ".join(tag_texts)
         except Exception:
             pass
 
-    combined = "\n".join(parts)
-    return html.unescape(combined).lower()
+    if "content" in entry:
+        try:
+            c = entry["content"]
+            if isinstance(c, dict):
+                c = [c]
+            elif isinstance(c, str):
+                c = [c]
+            remaining = content_limit
+            for ci in c if isinstance(c, list) else []:
+                if remaining <= 0:
+                    break
+                value = (ci.get("value") if isinstance(ci, dict) else str(ci)) or ""
+                value = value[:remaining]
+                remaining -= len(value)
+                yield value
+        except Exception:
+            pass
 
 
-# -----------------------
-# メイン関数（外部から呼ぶだけで完結）
-# -----------------------
-def fetch_from_rss(
-    feeds: Optional[List[str]] = None,
-    keywords: Optional[List[str]] = None,
-    fetch_images: bool = False,
-    verify_ssl: bool = True,
-    request_timeout: float = REQUEST_TIMEOUT,
-    user_agent: str = USER_AGENT,
-    max_articles_per_feed: Optional[int] = None,
-) -> List[dict]:
+def _match_entry(entry, matcher: KeywordMatcher) -> Set[str]:
     """
-    フィード一覧を巡回してパンダ関連記事を返す。
-    - feeds: RSS URL リスト（None の場合はデフォルト RSS_FEEDS）
-    - keywords: 検索キーワードリスト（None の場合は DEFAULT_KEYWORDS_LOWER）
-    - fetch_images: True なら get_main_image を呼ぶ（遅い）
-    - verify_ssl: SSL 検証を行うか（デバッグで False にすることは可）
+    entry のフィールドを安い順に照合し、最初にヒットしたフィールドのキーワードを返す
+    (どのフィールドにもヒットしなければ空集合)
     """
-    feeds_to_use = feeds or RSS_FEEDS
-    kw_list = [k.lower() for k in (keywords or DEFAULT_KEYWORDS_LOWER)]
+    for text in _entry_text_fields(entry):
+        if not text:
+            continue
+        found = matcher.matches(html.unescape(text).lower())
+        if found:
+            return found
+    return set()
 
-    print(f"--- RSSフィード巡回開始 ({len(feeds_to_use)} 件) ---")
-    all_articles: List[dict] = []
-    seen_urls = set()
-    skipped_samples: List[str] = []
 
-    for url in feeds_to_use:
-        print(f"[RSS] {url} を巡回中...")
-        feed, error = _get_feed_via_requests(url, user_agent, request_timeout, verify_ssl)
+def _iter_feed_articles(fetched, matcher: KeywordMatcher,
+                        max_articles_per_feed: Optional[int], known_urls: Optional[Collection[str]],
+                        seen_urls: UrlKeySet, skipped_samples: List[str], counts: Dict[str, int],
+                        checkpoint: Checkpoint, incremental: bool = True) -> Iterator[dict]:
+    """
+    取得済みフィード (url, feed, error) からキーワードに一致する記事を取り出す (画像は未補完)。
+    未更新のフィード数、DB保存済み・前回処理済みでスキップした記事数は counts に集計する
+    - checkpoint: 返す記事に印を付け、フィードを最後まで処理できたら位置と ETag / Last-Modified の確定を登録する
+      (確定は記事が保存されてから。Checkpoint を参照)
+    - incremental: True ならフィードごとの収集位置 (HighWaterMark) に記録した GUID の項目を読み飛ばす
+      (公開日時では判定しない。フィードが後から古い日付の項目を追加することがあるため)
+    """
+    for url, feed, error in fetched:
         if not feed:
-            if error:
+            if error is NOT_MODIFIED:
+                counts["not_modified"] += 1
+                print(f"  [未更新] {url} は前回から変更がないためスキップしました (304)")
+            elif error:
                 print(f"  [SKIP] {url} でエラー: {error}")
             else:
                 print(f"  [SKIP] {url} から有効なフィードが取得できませんでした")
             continue
 
-        source_title = feed.feed.get("title") or urlparse(url).netloc
-        entries = feed.entries or []
+        source_title = feed.get("title") or urlparse(url).netloc
+        entries = feed.get("entries") or []
+        feed_articles = 0
+        mark = HighWaterMark(f"rss:{url}", grace=None) if incremental else None
+        completed = True
         for entry in entries:
             article_url = entry.get("link")
             title = entry.get("title") or ""
             if not article_url or not title:
                 continue
 
-            # キーワード判定（title+summary+content+tags を結合して検索）
-            combined_text = _entry_combined_text(entry)
-            if not any(kw in combined_text for kw in kw_list):
-                skipped_samples.append(title or article_url or "<no title>")
-                continue
-
-            # published の安全取得
+            # 前回までに処理した項目は、キーワード照合もせずに読み飛ばす
+            entry_id = entry.get("id") or article_url
             dt_struct = entry.get("published_parsed") or entry.get("updated_parsed")
+            published_dt = None
             if dt_struct:
                 try:
-                    published_at = parse_published(dt_struct).isoformat()
+                    published_dt = parse_published(dt_struct)
                 except Exception:
-                    published_at = entry.get("published") or entry.get("updated") or None
+                    published_dt = None
+            if mark:
+                if mark.is_known(entry_id, published_dt):
+                    counts["seen"] += 1
+                    continue
+                mark.observe(entry_id, published_dt)
+
+            # キーワード判定（title → summary → tags → content の順に、ヒットした時点で打ち切り）
+            matched_keywords = _match_entry(entry, matcher)
+            if not matched_keywords:
+                skipped_samples.append(title or article_url or "<no title>")
+                continue
+
+            # published の安全取得
+            if published_dt is not None:
+                published_at = published_dt.isoformat()
             else:
                 published_at = entry.get("published") or entry.get("updated") or None
 
-            # 重複除去（URLベース）
+            # 重複除去（正規化したURLベース）
             if article_url in seen_urls:
                 continue
             seen_urls.add(article_url)
 
-            print(f"  [FOUND] {title} ({article_url})")
+            # DB保存済みの記事は画像取得も保存もしない
+            if known_urls and article_url in known_urls:
+                counts["known"] += 1
+                continue
 
-            image_url = None
-            if fetch_images and article_url:
-                try:
-                    image_url = get_main_image(article_url)
-                except Exception as e:
-                    print(f"    [IMG ERR] {e}")
+            print(f"  [FOUND] {title} ({article_url}) kw={sorted(matched_keywords)}")
+            # ヒットしたキーワードごとの件数を実行サマリー (metrics) に残す (重なり合う語もそれぞれ数える)
+            for keyword in matched_keywords:
+                incr("rss.keywords", label=keyword)
 
-            all_articles.append({
+            yield checkpoint.hold({
                 "title": title,
                 "article_url": article_url,
-                "image_url": image_url,
+                "image_url": None,
                 "source_name": source_title,
                 "published_at": published_at
             })
 
-            if max_articles_per_feed and len(all_articles) >= max_articles_per_feed:
+            feed_articles += 1
+            if max_articles_per_feed and feed_articles >= max_articles_per_feed:
+                completed = False
                 break
 
-    print(f"[収集完了] 総取得記事数: {len(all_articles)} (フィード候補: {len(feeds_to_use)})")
+        # 残りの項目を処理していない場合は位置を進めず、ETag / Last-Modified も記録しない
+        # (次回 304 にならず、もう一度見る)
+        if completed:
+            if mark:
+                checkpoint.on_commit(mark.commit)
+            if feed.get("validators") is not None:
+                checkpoint.on_commit(functools.partial(_remember_validators, url, feed["validators"]))
+
+
+# -----------------------
+# メイン関数（外部から呼ぶだけで完結）
+# -----------------------
+def iter_from_rss(
+    feeds: Optional[List[str]] = None,
+    keywords: Optional[List[str]] = None,
+    fetch_images: bool = False,
+    verify_ssl: bool = True,
+    request_timeout: float = REQUEST_TIMEOUT,
+    user_agent: str = USER_AGENT,
+    max_articles_per_feed: Optional[int] = None,
+    max_workers: int = MAX_FEED_WORKERS,
+    conditional_get: bool = True,
+    known_urls: Optional[Collection[str]] = None,
+    incremental: bool = True,
+    max_in_flight: int = ENRICH_CONCURRENCY,
+    checkpoint: Optional[Checkpoint] = None,
+) -> Iterator[dict]:
+    """
+    フィード一覧を巡回してパンダ関連記事を 1 件ずつ返す (ジェネレーター)。
+    フィードは並列に取得し、取得できたものから順に記事を返す。
+    - feeds: RSS URL リスト（None の場合はデフォルト RSS_FEEDS）
+    - keywords: 検索キーワードリスト（None の場合は DEFAULT_KEYWORDS_LOWER）
+    - fetch_images: True なら image_enricher で記事ページから画像を補完する（遅い）
+    - verify_ssl: SSL 検証を行うか（デバッグで False にすることは可）
+    - max_workers: フィード取得の並列数（同一ホストは MAX_CONNECTIONS_PER_HOST まで）
+    - conditional_get: True なら ETag / Last-Modified による条件付き GET を使い、
+      前回から更新のないフィードはパースせずにスキップする
+      (ETag / Last-Modified は、そのフィードの記事を最後まで処理して保存できたときだけ記録する。
+      ファイルへの保存は save_all_state_stores で行い、単体で呼んだ場合は保存しない)
+    - known_urls: DB に保存済みの記事URL。該当する記事は画像取得の前に除外する
+      (UrlKeySet なら、他のソースと重複する記事を画像の補完前に image_enricher が除く)
+    - incremental: True なら前回の実行までに処理したエントリー (GUID / 公開日時で判定) を読み飛ばす
+      (位置は state_store に記録。ファイルへの保存は save_all_state_stores で行う)
+    - max_in_flight: 画像を同時に補完する記事数の上限
+    - checkpoint: 記事の保存を確認してから収集位置を確定する場合に渡す (main の ArticleSink)。
+      None なら、返した記事をすべて受け取ってもらえたときに確定する
+    """
+    feeds_to_use = feeds or RSS_FEEDS
+    # キーワードは 1 つの正規表現にコンパイルし、1 回の走査で照合する
+    matcher = get_keyword_matcher(keywords or DEFAULT_KEYWORDS_LOWER)
+
+    print(f"--- RSSフィード巡回開始 ({len(feeds_to_use)} 件) ---")
+    total_articles = 0
+    seen_urls = UrlKeySet()  # 正規化したURLで比較 (utm_* や AMP の違いを無視)
+    skipped_samples: List[str] = []
+
+    fetched = _iter_feeds_concurrently(feeds_to_use, user_agent, request_timeout, verify_ssl,
+                                       max_workers, conditional_get)
+
+    counts = {"not_modified": 0, "known": 0, "seen": 0}
+    standalone = checkpoint is None
+    if standalone:
+        checkpoint = Checkpoint("RSS")
+    articles = _iter_feed_articles(fetched, matcher, max_articles_per_feed,
+                                   known_urls, seen_urls, skipped_samples, counts, checkpoint, incremental)
+    if fetch_images:
+        # 画像は image_enricher で並列に補完する (完了した記事から順に返す)
+        articles = iter_enriched(articles, max_in_flight, known_urls=known_urls)
+    if standalone:
+        articles = iter_committing(articles, checkpoint)
+    try:
+        for article in articles:
+            total_articles += 1
+            yield article
+    finally:
+        articles.close()
+        fetched.close()
+    # ETag / Last-Modified はここではファイルに保存しない。main (ArticleSink) から呼ばれた場合だけ、
+    # 記事の保存を確認してから save_all_state_stores で保存する
+    # (単体実行で保存すると、DB に保存していない記事のフィードが次回のバッチで 304 になるため)
+
+    incr("rss.articles", total_articles)
+    for key, value in counts.items():
+        incr(f"rss.{key}", value)
+    print(f"[収集完了] 総取得記事数: {total_articles} (フィード候補: {len(feeds_to_use)}, 未更新: {counts['not_modified']}, 前回処理済み: {counts['seen']}, 保存済み: {counts['known']})")
     if skipped_samples:
         print("  スキップサンプル(最大10):")
         for s in skipped_samples[:10]:
             print("   -", s)
 
-    return all_articles
+
+def fetch_from_rss(*args, **kwargs) -> List[dict]:
+    """iter_from_rss の結果をリストで返す (引数は iter_from_rss と同じ)"""
+    return list(iter_from_rss(*args, **kwargs))
 
 
 # 実行用
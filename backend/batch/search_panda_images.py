@@ -4,28 +4,174 @@ Google Custom Search API を使用したパンダ画像収集モジュール
 (ヘルパー関数を utils.py に移動)
 """
 
+import math
 import os
 import sys
-from datetime import datetime
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Collection, Iterator, Optional, List, Tuple
 import requests
 
 # 共通ヘルパーをインポート
-from utils import get_main_image, validate_image_url, SESSION
+from utils import SESSION
+from image_enricher import ENRICH_CONCURRENCY, IMAGE_HINT_KEY, REQUIRE_IMAGE_KEY, iter_enriched
+from state_store import Checkpoint, HighWaterMark, get_state_store, iter_committing
+from metrics import incr, timed
 
-def fetch_from_google_search(api_key: str, cx_id: str) -> List[dict]:
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")  # Custom Search のクォータは太平洋時間の 0 時にリセット
+except Exception:
+    QUOTA_TIMEZONE = timezone.utc
+
+# --- 設定 ---
+API_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_QUERY = 'panda OR "giant panda" OR パンダ OR ジャイアントパンダ'  # 既定の検索クエリ (sources.toml の options.query で変更可)
+TOTAL_PAGES_TO_TRY = 10   # API の上限 (start + num <= 100)
+ITEMS_PER_PAGE = 10
+PAGE_WORKERS = 3          # 2 ページ目以降を同時に取得するページ数 (1 ウェーブ)
+REQUEST_TIMEOUT = 10
+GOOGLE_DAILY_QUOTA = int(os.environ.get("GOOGLE_DAILY_QUOTA", "100"))  # 1 日あたりのリクエスト上限
+QUOTA_STORE = "google_quota"  # 当日のリクエスト数の保存先 (state_store)
+
+
+def _quota_day() -> str:
+    return datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+
+def _reserve_quota(requested: int, daily_quota: int) -> int:
     """
-    Google Custom Search API (Image) を使って
-    過去24時間 ('d1') のパンダの画像と元記事を取得する
-    (関数名を変更)
+    当日のクォータから最大 requested 回分を確保し、確保できた回数を返す。
+    使用数はリクエスト前にディスクへ書き出す (途中で落ちても使用分を数え漏らさない)
+    """
+    store = get_state_store(QUOTA_STORE)
+    day = _quota_day()
+    used = store.get("used", 0) if store.get("day") == day else 0
+    granted = max(0, min(requested, daily_quota - used))
+    if granted:
+        incr("google.quota_used", granted)
+        store.set("day", day)
+        store.set("used", used + granted)
+        store.save()
+    return granted
+
+
+def _handle_quota_error(error: requests.RequestException, daily_quota: int) -> None:
+    """API からクォータ超過 (429) が返ったときに、当日の残りを 0 にする"""
+    response = getattr(error, "response", None)
+    if response is None or response.status_code != 429:
+        return
+    store = get_state_store(QUOTA_STORE)
+    store.set("day", _quota_day())
+    store.set("used", daily_quota)
+    store.save()
+
+
+@timed("google.page")
+def _fetch_page(params: dict, page_index: int) -> Tuple[int, dict]:
+    """[内部] 指定ページ (0 始まり) を取得して (ページ番号, レスポンスJSON) を返す"""
+    page_params = dict(params, start=page_index * ITEMS_PER_PAGE + 1)
+    response = SESSION.get(API_URL, params=page_params, timeout=REQUEST_TIMEOUT)
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        print(f" [エラー詳細]: {response.text[:500]}")
+        raise
+    return page_index, response.json()
+
+
+def _search_items(params: dict, is_known, daily_quota: int) -> List[dict]:
+    """
+    [内部] 検索結果のページを取得して items を返す。
+    - 1 ページ目を取得して結果があることを確認してから、残りのページを PAGE_WORKERS ずつ並列に取得
+    - 総件数 (totalResults) から必要なページ数だけを取得し、当日のクォータを超えない
+    - 空のページ、またはすべて既知の記事だけのページが出たらそこで打ち切る
+    - エラーが起きても、それまでに取得したページの結果は残す
+    """
+    def page_is_stale(items: List[dict]) -> bool:
+        return all(is_known((it.get("image") or {}).get("contextLink")) for it in items)
+
+    if not _reserve_quota(1, daily_quota):
+        print(f" [クォータ] 本日のリクエスト上限 ({daily_quota} 回) に達しているため、検索をスキップします。")
+        return []
+
+    all_items: List[dict] = []
+    try:
+        _, data = _fetch_page(params, 0)
+    except requests.RequestException as e:
+        print(f" [APIリクエストエラー] 1 ページ目: {e}")
+        _handle_quota_error(e, daily_quota)
+        return []
+
+    items = data.get("items") or []
+    if not items:
+        print(" [情報] これ以上取得するアイテムがありません。")
+        return []
+    all_items.extend(items)
+    if page_is_stale(items):
+        print(" [情報] 1 ページ目はすべて既知の記事のため、ページングを終了します。")
+        return all_items
+
+    try:
+        total_results = int((data.get("searchInformation") or {}).get("totalResults") or 0)
+    except ValueError:
+        total_results = 0
+    total_pages = min(TOTAL_PAGES_TO_TRY, max(1, math.ceil(total_results / ITEMS_PER_PAGE)))
+
+    next_page = 1
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        while next_page < total_pages:
+            wave = min(PAGE_WORKERS, total_pages - next_page)
+            granted = _reserve_quota(wave, daily_quota)
+            if not granted:
+                print(f" [クォータ] 本日のリクエスト上限 ({daily_quota} 回) に達したため、{next_page} ページで打ち切ります。")
+                break
+            pages = range(next_page, next_page + granted)
+            next_page += granted
+
+            futures = [pool.submit(_fetch_page, params, page) for page in pages]
+            stop = False
+            # ページ順に結果を確認する。エラーになったページがあっても、取得できたページの結果は残す
+            for future in futures:
+                try:
+                    page, page_data = future.result()
+                except requests.RequestException as e:
+                    print(f" [APIリクエストエラー] {e} (取得できたページの結果で続行します)")
+                    _handle_quota_error(e, daily_quota)
+                    stop = True
+                    continue
+                page_items = page_data.get("items") or []
+                if not page_items:
+                    print(" [情報] これ以上取得するアイテムがありません。")
+                    stop = True
+                    break
+                all_items.extend(page_items)
+                if page_is_stale(page_items):
+                    print(f" [情報] {page + 1} ページ目はすべて既知の記事のため、ページングを終了します。")
+                    stop = True
+                    break
+            if stop:
+                break
+
+    incr("google.items", len(all_items))
+    return all_items
+
+
+def _iter_raw_google_search(api_key: str, cx_id: str, known_urls: Optional[Collection[str]],
+                            incremental: bool, daily_quota: int, checkpoint: Checkpoint,
+                            query: str = SEARCH_QUERY) -> Iterator[dict]:
+    """
+    [内部] Google Custom Search API (Image) を使って
+    過去24時間 ('d1') のパンダの画像と元記事を取得し、画像を補完する前の記事辞書を 1 件ずつ返す
+    - known_urls: DB に保存済みの記事URL。該当する記事は画像検証の前に除外し、ページングの打ち切りにも使う
+      (他のソースが処理中の記事は含まない。ソース間の重複は image_enricher が補完の前に除く)
+    - incremental: True なら前回の実行までに処理した元記事を読み飛ばす
+    - daily_quota: 1 日あたりの API リクエスト上限 (使用数は state_store に記録)
+    - checkpoint: 返す記事に印を付け、最後まで処理できたら収集位置の確定を登録する
+      (確定は記事が保存されてから。画像補完のタイムアウトで捨てた記事があれば確定しない)
+    - query: 検索クエリ
+    ページ内がすべて DB保存済み / 前回処理済みの記事になった時点でページングを止める (API クォータの節約)
     """
-    
-    API_URL = "https://www.googleapis.com/customsearch/v1"
-    query = 'panda OR "giant panda" OR パンダ OR ジャイアントパンダ'
-    
-    TOTAL_PAGES_TO_TRY = 10
-    ITEMS_PER_PAGE = 10
-    
     params = {
         "key": api_key,
         "cx": cx_id,
@@ -34,41 +180,22 @@ def fetch_from_google_search(api_key: str, cx_id: str) -> List[dict]:
         "dateRestrict": "d1",
         "num": ITEMS_PER_PAGE,
     }
-    
-    print(f"--- Google Custom Search API 実行中 (最大100件取得, q={query}) ---")
+    mark = HighWaterMark("google") if incremental else None
 
-    all_data_items = [] 
-    
-    for i in range(TOTAL_PAGES_TO_TRY):
-        params['start'] = (i * ITEMS_PER_PAGE) + 1
-        
-        try:
-            response = SESSION.get(API_URL, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            
-            items_on_this_page = data.get("items")
-            
-            if not items_on_this_page:
-                print(" [情報] これ以上取得するアイテムがありません。ループを終了します。")
-                break
-            
-            all_data_items.extend(items_on_this_page)
+    def is_known(url: Optional[str]) -> bool:
+        return bool(url) and ((mark is not None and mark.is_known(url)) or (bool(known_urls) and url in known_urls))
 
-        except requests.RequestException as e:
-            print(f" [APIリクエストエラー]: {e}")
-            if response is not None and hasattr(response, 'text'):
-                print(f" [エラー詳細]: {response.text}")
-            return [] 
+    print(f"--- Google Custom Search API 実行中 (最大{TOTAL_PAGES_TO_TRY * ITEMS_PER_PAGE}件取得, q={query}) ---")
 
-    results = []
-    items = all_data_items
+    items = _search_items(params, is_known, daily_quota)
     
     if not items:
         print(" [情報] 該当する画像は見つかりませんでした。")
-        return []
+        return
 
-    print(f"\n--- APIから取得した合計 {len(items)} 件の記事候補を検証します ---")
+    print(f"\n--- APIから取得した合計 {len(items)} 件の記事候補の画像を検証します ---")
+    skipped_known = 0
+    skipped_seen = 0
 
     for item in items:
         title = item.get("title", "(タイトルなし)")
@@ -80,37 +207,60 @@ def fetch_from_google_search(api_key: str, cx_id: str) -> List[dict]:
             print(f" [スキップ] 元記事のURLがありません: {title}")
             continue
 
-        print(f"\n* 検証中: {title}")
-        print(f"   元記事 (参考文献): {source_article_url}")
-
-        final_image_url = None
-
-        # ★ 共通ヘルパーを使用
-        if validate_image_url(google_image_url):
-            print(f"   [OK] Google提供の画像を採用: {google_image_url}")
-            final_image_url = google_image_url
-        else:
-            print(f"   [NG] Google提供の画像が無効。元記事をスクレイピングします...")
-            # ★ 共通ヘルパーを使用
-            scraped_image_url = get_main_image(source_article_url)
-            
-            if scraped_image_url:
-                print(f"   [OK] スクレイピングで画像を発見: {scraped_image_url}")
-                final_image_url = scraped_image_url
-            else:
-                print(f"   [FAIL] スクレイピングでも画像を発見できませんでした。")
-
-        if final_image_url:
-            results.append({
-                "title": title,
-                "article_url": source_article_url,
-                "image_url": final_image_url,
-                "source_name": source_name,
-                # Google Search APIは公開日を返さないため、現在時刻をセット
-                "published_at": datetime.now().isoformat() 
-            })
-
-    return results
+        if mark:
+            if mark.is_known(source_article_url):
+                skipped_seen += 1
+                continue
+            mark.observe(source_article_url)
+
+        if known_urls and source_article_url in known_urls:
+            skipped_known += 1
+            continue
+
+        # 画像の検証・補完は image_enricher でまとめて並列に行う
+        # (Google提供の画像が無効なら元記事から探し、それでも無ければ除外する)
+        yield checkpoint.hold({
+            "title": title,
+            "article_url": source_article_url,
+            "image_url": None,
+            "source_name": source_name,
+            # Google Search APIは公開日を返さないため、現在時刻をセット
+            "published_at": datetime.now().isoformat(),
+            IMAGE_HINT_KEY: google_image_url,
+            REQUIRE_IMAGE_KEY: True,
+        })
+
+    if skipped_known:
+        print(f" [情報] DB保存済みの {skipped_known} 件は検証をスキップしました。")
+    if skipped_seen:
+        print(f" [情報] 前回処理済みの {skipped_seen} 件は検証をスキップしました。")
+    if mark:
+        checkpoint.on_commit(mark.commit)
+
+
+def iter_from_google_search(api_key: str, cx_id: str, known_urls: Optional[Collection[str]] = None,
+                            incremental: bool = True, daily_quota: int = GOOGLE_DAILY_QUOTA,
+                            query: str = SEARCH_QUERY, max_in_flight: int = ENRICH_CONCURRENCY,
+                            checkpoint: Optional[Checkpoint] = None) -> Iterator[dict]:
+    """
+    過去24時間のパンダの画像と元記事を取得し、画像を確認できた記事から 1 件ずつ返す。
+    画像の検証・補完は image_enricher で最大 max_in_flight 件ずつ並列に行う
+    checkpoint が None なら、返した記事をすべて受け取ってもらえたときに収集位置を確定する
+    (その他の引数は _iter_raw_google_search を参照)
+    """
+    standalone = checkpoint is None
+    if standalone:
+        checkpoint = Checkpoint("Google Search API")
+    articles = iter_enriched(_iter_raw_google_search(api_key, cx_id, known_urls, incremental, daily_quota,
+                                                     checkpoint, query), max_in_flight,
+                             known_urls=known_urls)
+    return iter_committing(articles, checkpoint) if standalone else articles
+
+
+def fetch_from_google_search(api_key: str, cx_id: str, known_urls: Optional[Collection[str]] = None,
+                             incremental: bool = True, daily_quota: int = GOOGLE_DAILY_QUOTA) -> List[dict]:
+    """iter_from_google_search の結果をリストで返す"""
+    return list(iter_from_google_search(api_key, cx_id, known_urls, incremental, daily_quota))
 
 
 # --- 単体実行 (テスト) ---
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+収集ソースのレジストリ
+- 組み込みのソースは DEFAULT_SOURCES に 1 か所だけ定義する
+  (フィード一覧や検索クエリなどの既定値は各コレクターのモジュールに置く)
+- sources.toml (場所は BATCH_SOURCES_CONFIG。未設定なら batch/sources.toml) には、
+  既定値から変える項目と、追加するソースだけを書く。ファイルが無ければ DEFAULT_SOURCES のまま動く
+- 各ソースは 名前・コレクター ("モジュール:関数")・必要な環境変数・優先度・期限・
+  同時実行数・コレクターに渡す追加の引数 (options) を持つ
+- コレクターのモジュールはソースを実際に動かすときに読み込む (起動を軽くするため)
+"""
+
+import importlib
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from metrics import timer
+
+try:
+    import tomllib  # Python 3.11+
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+SOURCES_CONFIG_PATH = os.environ.get("BATCH_SOURCES_CONFIG") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "sources.toml"
+)
+DEFAULT_PRIORITY = 100  # 値が小さいソースから先に開始する
+
+# 組み込みのソース一覧 (feeds やクエリなどは各コレクターの既定値を使う)。
+# sources.toml で同じ name のソースを書くと、書いた項目だけがこの定義を上書きする
+DEFAULT_SOURCES: List[Dict[str, Any]] = [
+    {"name": "Google Search API", "collector": "search_panda_images:iter_from_google_search",
+     "env": ["GOOGLE_API_KEY", "CUSTOM_SEARCH_CX"], "priority": 10},
+    {"name": "NewsAPI", "collector": "article_collector:iter_from_newsapi",
+     "env": ["NEWS_API_KEY"], "priority": 20},
+    {"name": "RSSフィード", "collector": "rss_collector:iter_from_rss", "priority": 30},
+]
+
+_SOURCE_KEYS = {"name", "collector", "env", "enabled", "priority", "timeout", "concurrency", "options"}
+
+
+class SourceSpec:
+    """
+    収集ソース 1 件の設定。
+    コレクター関数は 必要な環境変数の値 を位置引数に、known_urls・checkpoint と options をキーワード引数に受け取り、
+    記事のイテレーターを返す (concurrency を指定した場合は max_in_flight として渡す)
+    """
+
+    def __init__(self, name: str, collector: str, env: Iterable[str] = (), enabled: bool = True,
+                 priority: int = DEFAULT_PRIORITY, timeout: Optional[float] = None,
+                 concurrency: Optional[int] = None, options: Optional[Dict[str, Any]] = None):
+        if ":" not in collector:
+            raise ValueError(f"ソース {name}: collector は \"モジュール:関数\" の形式で指定してください ({collector})")
+        self.name = name
+        self.collector = collector
+        self.env = list(env)
+        self.enabled = enabled
+        self.priority = priority
+        self.timeout = float(timeout) if timeout is not None else None
+        self.concurrency = int(concurrency) if concurrency is not None else None
+        self.options = dict(options or {})
+
+    def __repr__(self) -> str:
+        return f"SourceSpec({self.name!r}, {self.collector!r}, priority={self.priority})"
+
+    def missing_env(self) -> List[str]:
+        """設定されていない環境変数の名前を返す"""
+        return [name for name in self.env if not os.environ.get(name)]
+
+    def load(self) -> Callable[..., Iterable[dict]]:
+        """コレクター関数を読み込んで返す (読み込み時間は import.<モジュール名> に記録)"""
+        module_name, _, func_name = self.collector.partition(":")
+        with timer(f"import.{module_name}"):
+            module = importlib.import_module(module_name)
+        return getattr(module, func_name)
+
+    def make_iter(self, **kwargs) -> Iterable[dict]:
+        """コレクターを呼び出して記事のイテレーターを返す (kwargs は options より優先)"""
+        func = self.load()
+        call_kwargs = dict(self.options)
+        if self.concurrency is not None:
+            call_kwargs["max_in_flight"] = self.concurrency
+        call_kwargs.update(kwargs)
+        return func(*[os.environ.get(name) for name in self.env], **call_kwargs)
+
+
+def _parse_source(raw: Dict[str, Any]) -> SourceSpec:
+    unknown = set(raw) - _SOURCE_KEYS
+    if unknown:
+        raise ValueError(f"ソース {raw.get('name', '?')}: 不明な設定項目があります ({', '.join(sorted(unknown))})")
+    if not raw.get("name") or not raw.get("collector"):
+        raise ValueError(f"ソースには name と collector が必要です ({raw})")
+    return SourceSpec(**raw)
+
+
+def _merge_sources(overrides: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    [内部] DEFAULT_SOURCES に設定ファイルの内容を重ねる。
+    同じ name のソースは書かれた項目だけを上書きし (options はキーごと)、それ以外は新しいソースとして追加する
+    """
+    names = [raw.get("name") for raw in overrides]
+    duplicated = sorted({str(name) for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"ソース名が重複しています ({', '.join(duplicated)})")
+
+    merged = {raw["name"]: dict(raw) for raw in DEFAULT_SOURCES}
+    for raw in overrides:
+        base = merged.get(raw.get("name"))
+        if base is None:
+            merged[raw.get("name")] = dict(raw)
+            continue
+        options = dict(base.get("options") or {})
+        options.update(raw.get("options") or {})
+        base.update(raw)
+        base["options"] = options
+    return list(merged.values())
+
+
+def load_sources(path: Optional[str] = SOURCES_CONFIG_PATH, include_disabled: bool = False) -> List[SourceSpec]:
+    """
+    DEFAULT_SOURCES に設定ファイルの上書き・追加を反映したソース一覧を、優先度順に返す。
+    ファイルが無い (または TOML を読み込めない) 場合は DEFAULT_SOURCES のまま使う。
+    設定の誤り (不明な項目・形式の誤り) は ValueError として送出する
+    """
+    overrides: List[Dict[str, Any]] = []
+    if path and os.path.exists(path):
+        if tomllib is None:
+            print(f" [ソース設定] TOML を読み込めないため ({path})、既定のソース一覧を使います (pip install tomli)")
+        else:
+            with open(path, "rb") as f:
+                config = tomllib.load(f)
+            overrides = config.get("sources", [])
+            print(f" [ソース設定] {path} から {len(overrides)} 件のソース設定を読み込みました。")
+    else:
+        print(" [ソース設定] 設定ファイルが無いため、既定のソース一覧を使います。")
+
+    sources = [_parse_source(raw) for raw in _merge_sources(overrides)]
+    if not include_disabled:
+        sources = [spec for spec in sources if spec.enabled]
+    # 優先度が同じなら DEFAULT_SOURCES → 設定ファイルの記載順 (sorted は安定ソート)
+    return sorted(sources, key=lambda spec: spec.priority)
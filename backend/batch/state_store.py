@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+バッチ状態ストア
+- 実行をまたいで保持したい小さな状態 (フィードの ETag / Last-Modified など) を
+  JSON ファイルとしてディスクに保存
+- 保存先は BATCH_STATE_DIR (未設定なら batch/.cache)
+- ソース / フィードごとの収集位置 (High-water mark) もここに保存し、
+  前回までに処理した項目を次回の実行で読み飛ばす
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+STATE_DIR = os.environ.get("BATCH_STATE_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".cache"
+)
+
+HIGH_WATER_STORE = "high_water_marks"  # 収集位置の保存先
+HIGH_WATER_MAX_IDS = 500               # ソースごとに覚えておく GUID / URL の最大数
+HIGH_WATER_GRACE = 6 * 3600            # 前回の最新よりこの秒数以上古い公開日時の項目は処理済みとみなす
+CHECKPOINT_KEY = "_checkpoint"         # 記事辞書に付ける Checkpoint (保存時に取り除かれ、DB には保存されない)
+
+
+class JsonStateStore:
+    """キー → JSON 値 の辞書を 1 ファイルに永続化する (スレッドセーフ)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = {}
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            if isinstance(loaded, dict):
+                self._data = loaded
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f" [状態ストア] {path} を読み込めませんでした (空の状態で開始): {e}")
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._dirty = True
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._dirty = True
+
+    def save(self) -> None:
+        """変更があればアトミックに書き出す (一時ファイル → rename)"""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._data, f, ensure_ascii=False, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+                self._dirty = False
+            except Exception as e:
+                print(f" [状態ストア] {self.path} を保存できませんでした: {e}")
+
+
+_stores: Dict[str, JsonStateStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store(name: str, state_dir: Optional[str] = None) -> JsonStateStore:
+    """名前付きの状態ストア (STATE_DIR/<name>.json) を返す。同名なら同じインスタンス"""
+    path = os.path.join(state_dir or STATE_DIR, f"{name}.json")
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = JsonStateStore(path)
+            _stores[path] = store
+        return store
+
+
+def save_all_state_stores() -> None:
+    """読み込まれたすべての状態ストアを保存する"""
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.save()
+
+
+class HighWaterMark:
+    """
+    ソース / フィードごとの収集位置 (最新の公開日時と、最近処理した GUID / URL)
+    - is_known(): 前回までに処理した項目か (GUID が既知、または公開日時が最新より十分古い)
+    - observe(): 今回処理した項目を記録する
+    - commit(): 記録を状態ストアに反映する。最後まで処理できたときだけ呼び、
+      途中で打ち切られたソースの位置は進めない (ファイルへの保存は save_all_state_stores)。
+      記事の保存を待つ場合は Checkpoint.on_commit に登録する
+    - grace=None なら公開日時では判定せず、GUID だけで判定する
+      (フィードが後から古い日付の項目を追加しても取りこぼさない)
+    """
+
+    def __init__(self, key: str, store: Optional[JsonStateStore] = None,
+                 max_ids: int = HIGH_WATER_MAX_IDS, grace: Optional[float] = HIGH_WATER_GRACE):
+        self.key = key
+        self.store = store or get_state_store(HIGH_WATER_STORE)
+        self.max_ids = max_ids
+        self.grace = grace
+        saved = self.store.get(key) or {}
+        self.newest: Optional[float] = saved.get("newest_ts")
+        self._ids: List[str] = list(saved.get("ids") or [])
+        self._known = set(self._ids)
+        self._observed: List[str] = []
+        self._observed_newest = self.newest
+
+    @staticmethod
+    def _timestamp(published) -> Optional[float]:
+        if published is None:
+            return None
+        if isinstance(published, datetime):
+            try:
+                return published.timestamp()
+            except Exception:
+                return None
+        return float(published)
+
+    @property
+    def since(self) -> Optional[float]:
+        """前回の最新から猶予を引いた Unix 時刻 (API の期間指定用)。初回は None"""
+        if self.newest is None:
+            return None
+        return self.newest - (self.grace or 0)
+
+    def is_known(self, item_id: Optional[str], published=None) -> bool:
+        if item_id and item_id in self._known:
+            return True
+        ts = self._timestamp(published)
+        if self.grace is None:
+            return False
+        return ts is not None and self.newest is not None and ts < self.newest - self.grace
+
+    def observe(self, item_id: Optional[str], published=None) -> None:
+        if item_id and item_id not in self._known:
+            self._known.add(item_id)
+            self._observed.append(item_id)
+        ts = self._timestamp(published)
+        if ts is not None:
+            ts = min(ts, time.time())  # 未来の日付を付けた項目で位置が先に進みすぎないように
+        if ts is not None and (self._observed_newest is None or ts > self._observed_newest):
+            self._observed_newest = ts
+
+    def commit(self) -> None:
+        if not self._observed and self._observed_newest == self.newest:
+            return
+        self._ids = (self._ids + self._observed)[-self.max_ids:]
+        self._observed = []
+        self.newest = self._observed_newest
+        value = {"ids": self._ids}
+        if self.newest is not None:
+            value["newest_ts"] = self.newest
+            value["newest"] = datetime.fromtimestamp(self.newest).isoformat()
+        self.store.set(self.key, value)
+
+
+class Checkpoint:
+    """
+    1 ソースの 1 回の収集で進める状態 (収集位置・ETag など) を、記事の保存が終わるまで確定しないためのまとめ役
+    - コレクターは返す記事に hold() で印を付け、フィードなどを最後まで処理したら確定処理を on_commit() に登録する
+    - 保存処理は、保存できた (または確定的に不要と判断した) 記事を release(ok=True)、
+      保存できなかった記事・タイムアウトなどで処理しきれなかった記事を release(ok=False) する
+    - commit() は 印を付けた記事がすべて ok で返ってきたときだけ登録された確定処理を実行する
+      (期限切れ・エラーで終わったソースでは呼ばない)
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._lock = threading.Lock()
+        self._held = 0
+        self._failed = 0
+        self._actions: List[Callable[[], None]] = []
+
+    def hold(self, article: dict) -> dict:
+        """記事に印を付けて返す"""
+        with self._lock:
+            self._held += 1
+        article[CHECKPOINT_KEY] = self
+        return article
+
+    def on_commit(self, action: Callable[[], None]) -> None:
+        with self._lock:
+            self._actions.append(action)
+
+    def settle(self, ok: bool) -> None:
+        """hold() した記事 1 件の処理結果を伝える (記事辞書が手元に無い場合に使う)"""
+        with self._lock:
+            self._held -= 1
+            if not ok:
+                self._failed += 1
+
+    @staticmethod
+    def release(article: dict, ok: bool) -> None:
+        """記事の処理結果を、印を付けた Checkpoint に伝える (印が無ければ何もしない)"""
+        checkpoint = article.pop(CHECKPOINT_KEY, None)
+        if checkpoint is not None:
+            checkpoint.settle(ok)
+
+    def commit(self) -> bool:
+        """すべての記事が処理済みなら確定処理を実行して True を返す"""
+        with self._lock:
+            if self._held or self._failed:
+                print(f" [収集位置] {self.name or 'ソース'}: 保存できなかった記事 {self._failed} 件 / 未処理 {self._held} 件があるため、位置を進めません")
+                return False
+            actions, self._actions = self._actions, []
+        for action in actions:
+            action()
+        return True
+
+
+def iter_committing(articles: Iterable[dict], checkpoint: Checkpoint) -> Iterator[dict]:
+    """
+    コレクターを単体で呼んだ場合 (保存処理が Checkpoint を扱わない場合) に使う。
+    呼び出し元に渡した記事を処理済みとみなし、最後まで渡せたときだけ確定する
+    (途中で打ち切られたら確定しない)
+    """
+    for article in articles:
+        Checkpoint.release(article, True)
+        yield article
+    checkpoint.commit()
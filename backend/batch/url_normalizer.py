@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+記事URLの正規化・重複除去モジュール
+- トラッキング用パラメータ (utm_* など)、フラグメント、AMP 形式を取り除く
+- 記事HTMLの <link rel="canonical"> が分かっていればそれを優先する
+- 正規化したURLをキーに、ソースをまたいだ重複記事を 1 件にまとめる
+- 正規化したURLは重複判定のキーにだけ使う。保存する article_url は
+  <link rel="canonical"> のURL か元のURLのままにする (正規化で書き換えない)
+"""
+
+import re
+import threading
+from typing import Iterable, List, Optional, Set
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+from cache_store import TTLCache
+
+# 除去するクエリパラメータ (小文字で比較)
+TRACKING_PARAM_PREFIXES = ("utm_",)
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "yclid", "msclkid", "igshid", "mc_cid", "mc_eid",
+    "_ga", "ocid", "cmpid", "amp", "outputtype",
+}
+
+# 正規化した記事URL → <link rel="canonical"> のURL (get_main_image が HTML を取得したときに記録)
+CANONICAL_URL_CACHE = TTLCache("canonical_url", maxsize=20000, ttl=30 * 86400, negative_ttl=0)
+
+_GOOGLE_AMP_RE = re.compile(r"^/amp/(s/)?(?P<rest>.+)$")
+_AMPPROJECT_RE = re.compile(r"^/[a-z]/(s/)?(?P<rest>.+)$")
+
+
+def _unwrap_amp_cache(parts):
+    """Google / ampproject の AMP キャッシュURLを元記事のURLに戻す"""
+    host = parts.netloc.lower()
+    if host.endswith("cdn.ampproject.org"):
+        m = _AMPPROJECT_RE.match(parts.path)
+    elif host in ("www.google.com", "google.com"):
+        m = _GOOGLE_AMP_RE.match(parts.path)
+    else:
+        return parts
+    if not m:
+        return parts
+    scheme = "https" if m.group(1) else "http"
+    return urlsplit(f"{scheme}://{m.group('rest')}" + (f"?{parts.query}" if parts.query else ""))
+
+
+def _is_tracking_param(segment: str) -> bool:
+    """[内部] クエリの 1 項目 ("name=value" / "name") がトラッキング用パラメータか"""
+    name = unquote_plus(segment.split("=", 1)[0]).lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def _clean_url(url: str) -> str:
+    """
+    重複判定用に、トラッキングパラメータ・フラグメント・AMP 表記を除去したURLを返す
+    (クエリは & で区切った項目を取り除くだけで、残りの項目は元の表記のままにする)
+    """
+    parts = _unwrap_amp_cache(urlsplit(url.strip()))
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+
+    path = parts.path or "/"
+    # /article/amp, /article/amp/ → /article/ ,  article.amp.html → article.html
+    path = re.sub(r"/amp/?$", "/", path)
+    path = re.sub(r"\.amp(\.html?)$", r"\1", path)
+
+    query = "&".join(
+        segment for segment in parts.query.split("&")
+        if segment and not _is_tracking_param(segment)
+    )
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def canonicalize_url(url: str) -> str:
+    """記事URLを重複判定用に正規化する。canonical URL が記録済みならそれを正規化して返す"""
+    if not url or not url.startswith("http"):
+        return url
+    try:
+        cleaned = _clean_url(url)
+    except Exception:
+        return url
+    canonical = CANONICAL_URL_CACHE.get(cleaned, None)
+    if canonical and canonical != cleaned:
+        try:
+            return _clean_url(canonical)
+        except Exception:
+            pass
+    return cleaned
+
+
+def canonical_article_url(url: str) -> str:
+    """
+    保存に使う記事URLを返す。<link rel="canonical"> が記録済みならそのURL、
+    無ければ元のURLをそのまま返す (正規化したURLは返さない)
+    """
+    if not url or not url.startswith("http"):
+        return url
+    try:
+        cleaned = _clean_url(url)
+    except Exception:
+        return url
+    return CANONICAL_URL_CACHE.get(cleaned, None) or url
+
+
+def remember_canonical_url(article_url: str, canonical_href: Optional[str]) -> None:
+    """記事HTMLで見つけた <link rel="canonical"> を記録する (http(s) のものだけ。URLは書き換えずに記録する)"""
+    if not article_url or not canonical_href or not canonical_href.startswith("http"):
+        return
+    canonical_href = canonical_href.strip()
+    try:
+        cleaned = _clean_url(article_url)
+        if _clean_url(canonical_href) == cleaned:
+            return
+    except Exception:
+        return
+    CANONICAL_URL_CACHE.set(cleaned, canonical_href)
+
+
+def url_dedup_key(url: str) -> str:
+    """
+    重複判定用のキー。正規化に加え、スキーム (http/https)・先頭の www.・
+    末尾のスラッシュの違いを無視する
+    """
+    canonical = canonicalize_url(url or "")
+    parts = urlsplit(canonical)
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path.rstrip("/") or "/"
+    return f"{host}{path}" + (f"?{parts.query}" if parts.query else "")
+
+
+class UrlKeySet:
+    """
+    url_dedup_key で比較する URL の集合 (`url in known_urls` の形で使う)。
+    claim() で付けた「処理中」の印は `in` の判定には含めず、claim() どうしの重複判定にだけ使う
+    (他のソースが処理中の記事を、保存済みの記事と取り違えないように)。
+    claim() / discard() は複数のコレクタースレッドから呼べる
+    """
+
+    def __init__(self, urls: Iterable[str] = ()):
+        self._keys = {url_dedup_key(u) for u in urls if u}
+        self._claimed: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def add(self, url: str) -> None:
+        self._keys.add(url_dedup_key(url))
+
+    def claim(self, url: str) -> bool:
+        """url に処理中の印を付ける。集合に含まれる・既に印がある場合は付けずに False を返す"""
+        key = url_dedup_key(url)
+        with self._lock:
+            if key in self._keys or key in self._claimed:
+                return False
+            self._claimed.add(key)
+            return True
+
+    def discard(self, url: str) -> None:
+        """claim() の印を外す"""
+        with self._lock:
+            self._claimed.discard(url_dedup_key(url))
+
+    def __contains__(self, url) -> bool:
+        return bool(url) and url_dedup_key(url) in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+
+def dedupe_articles(articles: List[dict], seen_keys: Optional[Set[str]] = None) -> List[dict]:
+    """
+    正規化したURL (url_dedup_key) が同じ記事を 1 件にまとめる。
+    先に来た記事を残し、画像が無ければ重複側の画像で補う。https を優先する。
+    残す記事の article_url は canonical_article_url (canonical URL か元のURL) にする。
+    - seen_keys: 以前のバッチで処理済みのキー。含まれる記事は除外し、今回残した記事のキーを追加する
+      (マイクロバッチで保存する場合に、バッチをまたいだ重複を除くために使う)
+    """
+    kept = {}
+    for article in articles:
+        url = article.get("article_url")
+        if not url:
+            continue
+        canonical = canonical_article_url(url)
+        key = url_dedup_key(url)
+        if seen_keys is not None and key in seen_keys:
+            continue
+        existing = kept.get(key)
+        if existing is None:
+            kept[key] = dict(article, article_url=canonical)
+            continue
+        if not existing.get("image_url") and article.get("image_url"):
+            existing["image_url"] = article["image_url"]
+        if existing["article_url"].startswith("http:") and canonical.startswith("https:"):
+            existing["article_url"] = canonical
+
+    if seen_keys is not None:
+        seen_keys.update(kept)
+
+    removed = len(articles) - len(kept)
+    if removed:
+        print(f" [重複除去] {removed} 件の重複記事をまとめました ({len(articles)} → {len(kept)} 件)")
+    return list(kept.values())
@@ -1,27 +1,48 @@
 #!/usr/bin/env python3
 """
 共通ヘルパーモジュール
-- HTTPリクエスト
-- 画像URLの検証
-- 記事ページからの画像抽出 (OGP, JSON-LD, etc.)
+- HTTPリクエスト (スクレイピング・画像検証は http_engine の共有非同期クライアント、
+  各種APIは requests の SESSION)
+- 画像URLの検証 (先頭バイトで形式・寸法を判定。結果は cache_store でキャッシュ)
+- 記事ページからの画像抽出 (OGP, JSON-LD, etc.) (記事URL → 画像URL もキャッシュ)
+  (パース処理そのものは page_parser.py、別プロセスでの実行は parse_pool.py)
 - 日付のパース
 """
 
-import json
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import httpx
 from datetime import datetime
 from email.utils import parsedate_to_datetime
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from time import mktime
 
+from cache_store import TTLCache, MISSING
+from url_normalizer import remember_canonical_url
+from http_engine import get_engine
+from host_guard import GuardedSession, HostUnavailableError
+from image_probe import sniff_image
+from page_parser import extract_page_info, parse_html
+from parse_pool import run_parse_async
+from metrics import incr, timed
+
 # --- 定数 ---
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
 HTTP_TIMEOUT = 10
-MIN_IMAGE_BYTES = 512
-SESSION = requests.Session()
+MIN_IMAGE_DIMENSION = 100     # これより幅・高さが小さい画像はトラッキングピクセル / アイコンとして除外
+IMAGE_PROBE_BYTES = 32 * 1024  # 画像検証で Range リクエストする先頭バイト数 (JPEG の EXIF を考慮)
+IMAGE_VALIDATION_WORKERS = 16  # 画像候補を同時に検証する最大数 (全呼び出しで共有)
+HEAD_BYTE_LIMIT = 256 * 1024   # </head> が見つからなくても、ここまで読んだら <head> の解析に進む
+MAX_PAGE_BYTES = 5 * 1024 * 1024  # 本文を読み込む最大サイズ
+
+# ホストごとの流量制限・サーキットブレーカー付きのセッション (host_guard)
+SESSION = GuardedSession()
 SESSION.headers.update({"User-Agent": USER_AGENT, "Accept-Language": "ja,en-US;q=0.9,en;q=0.8"})
 
+# 画像URLの検証結果キャッシュ (有効: 7日 / 無効: 6時間)
+IMAGE_VALIDATION_CACHE = TTLCache("image_validation", maxsize=20000, ttl=7 * 86400, negative_ttl=6 * 3600)
+# 記事URL → メイン画像URL のキャッシュ (画像なし (None) も 12時間 保持)
+ARTICLE_IMAGE_CACHE = TTLCache("article_image", maxsize=20000, ttl=7 * 86400, negative_ttl=12 * 3600)
+
 # --- 共通ヘルパー関数 ---
 
 def parse_published(pubval) -> datetime:
@@ -57,111 +78,272 @@ def parse_published(pubval) -> datetime:
     return datetime.now()
 
 
-def fetch_html(url: str, timeout: int = HTTP_TIMEOUT) -> Optional[tuple]:
-    """[内部] HTMLを取得して BeautifulSoup オブジェクトを返す"""
+@timed("page.fetch")
+async def _fetch_page_async(url: str, timeout: float = HTTP_TIMEOUT) -> Optional[tuple]:
+    """[内部] ページを取得して (最終URL, 本文バイト列) を返す"""
     try:
-        resp = SESSION.get(url, timeout=timeout, allow_redirects=True)
+        resp = await get_engine().get(url, timeout=timeout)
         resp.raise_for_status()
-        # 最終的なURLとBeautifulSoupオブジェクトを返す
-        return resp.url, BeautifulSoup(resp.text, "html.parser")
-    except requests.RequestException as e:
+        return str(resp.url), resp.content
+    except (httpx.HTTPError, httpx.InvalidURL, HostUnavailableError) as e:
         print(f" [fetch_html エラー] {url} : {e}")
         return None
 
 
-def validate_image_url(img_url: str, timeout: int = 6) -> bool:
-    """[内部] 提供された画像URLが有効か検証する"""
+async def fetch_html_async(url: str, timeout: float = HTTP_TIMEOUT) -> Optional[tuple]:
+    """[内部] HTMLを取得して (最終URL, BeautifulSoup オブジェクト) を返す (非同期版)"""
+    page = await _fetch_page_async(url, timeout)
+    if not page:
+        return None
+    final_url, content = page
+    # パースは CPU 処理なので、イベントループを止めないよう別スレッドで行う
+    soup = await asyncio.get_running_loop().run_in_executor(None, parse_html, content)
+    return final_url, soup
+
+
+def fetch_html(url: str, timeout: int = HTTP_TIMEOUT) -> Optional[tuple]:
+    """[内部] HTMLを取得して BeautifulSoup オブジェクトを返す"""
+    return get_engine().run(fetch_html_async(url, timeout))
+
+
+async def _read_image_head(img_url: str, timeout: float) -> Optional[tuple]:
+    """
+    [内部] Range リクエストで画像の先頭 IMAGE_PROBE_BYTES バイトだけを取得する
+    サーバーが Range を無視して 200 で全体を返しても、先頭部分を読んだら接続を切る
+    戻り値: (ステータスコード, 先頭バイト列) (通信エラーは例外のまま送出)
+    """
+    headers = {"Range": f"bytes=0-{IMAGE_PROBE_BYTES - 1}", "Accept": "image/*,*/*;q=0.8"}
+    async with get_engine().stream("GET", img_url, headers=headers, timeout=timeout) as resp:
+        if resp.status_code >= 400:
+            return resp.status_code, b""
+        buf = bytearray()
+        async for chunk in resp.aiter_bytes():
+            buf.extend(chunk)
+            if len(buf) >= IMAGE_PROBE_BYTES:
+                break
+        return resp.status_code, bytes(buf[:IMAGE_PROBE_BYTES])
+
+
+@timed("image.validate")
+async def _validate_image_url_uncached(img_url: str, timeout: float) -> bool:
+    """
+    [内部] ネットワークで画像URLを検証する (通信エラーは例外のまま送出)
+    先頭バイトのマジックナンバーで形式を判定し、ヘッダーから読めた幅・高さが
+    MIN_IMAGE_DIMENSION 未満のもの (トラッキングピクセル・アイコン) は無効とする
+    """
+    status, data = await _read_image_head(img_url, timeout)
+    if status >= 400:
+        return False
+    info = sniff_image(data)
+    if info is None:
+        return False
+    _fmt, width, height = info
+    if width is None or height is None:
+        # 先頭部分から寸法が読めない形式 (SVG, AVIF など) は形式の判定だけで有効とする
+        return True
+    return min(width, height) >= MIN_IMAGE_DIMENSION
+
+
+async def _check_image_url_async(img_url: str, timeout: float = 6, use_cache: bool = True) -> Optional[bool]:
+    """
+    [内部] 画像URLを検証し、有効なら True・無効なら False、
+    通信エラー (ホストの遮断を含む) で判定できなかった場合は None を返す
+    判定結果は IMAGE_VALIDATION_CACHE に保存し、同じURLは再検証しない (None はキャッシュしない)
+    """
+    if not img_url or not img_url.startswith("http"):
+        return False
+
+    if use_cache:
+        cached = IMAGE_VALIDATION_CACHE.get(img_url)
+        if cached is not MISSING:
+            return cached
+
     try:
-        if not img_url or not img_url.startswith("http"):
-            return False
-        
-        # HEADリクエストで Content-Type と Content-Length を確認
-        try:
-            head = SESSION.head(img_url, timeout=timeout, allow_redirects=True)
-            if head.status_code >= 400: return False
-            ct = head.headers.get("Content-Type", "")
-            if not ct.startswith("image/"): return False
-            cl = head.headers.get("Content-Length")
-            if cl and int(cl) < MIN_IMAGE_BYTES: return False
-            return True
-        
-        # HEADが失敗した場合 (サーバーがHEADをサポートしていない場合)
-        except Exception:
-            g = SESSION.get(img_url, timeout=timeout, stream=True)
-            if g.status_code >= 400: return False
-            ct = g.headers.get("Content-Type", "") or ""
-            if not ct.startswith("image/"): return False
-            first_chunk = next(g.iter_content(1024), b"")
-            g.close()
-            return len(first_chunk) >= 16
-            
+        valid = await _validate_image_url_uncached(img_url, timeout)
     except Exception as e:
         print(f"   [validate_image 例外] {img_url} : {e}")
+        incr("image.validate_result", label="error")
+        return None
+    incr("image.validate_result", label="valid" if valid else "invalid")
+
+    if use_cache:
+        IMAGE_VALIDATION_CACHE.set(img_url, valid)
+    return valid
+
+
+async def validate_image_url_async(img_url: str, timeout: float = 6, use_cache: bool = True) -> bool:
+    """
+    [内部] 提供された画像URLが有効か検証する (非同期版)
+    判定結果は IMAGE_VALIDATION_CACHE に保存し、同じURLは再検証しない
+    (通信エラーで判定できなかった場合は False を返し、キャッシュしない)
+    """
+    return bool(await _check_image_url_async(img_url, timeout, use_cache))
+
+
+def validate_image_url(img_url: str, timeout: int = 6, use_cache: bool = True) -> bool:
+    """[内部] 提供された画像URLが有効か検証する (validate_image_url_async の同期版)"""
+    if not img_url or not img_url.startswith("http"):
         return False
+    return get_engine().run(validate_image_url_async(img_url, timeout, use_cache))
 
-def get_main_image(article_url: str) -> Optional[str]:
+
+@timed("html.parse")
+async def _extract_page_info_async(final_url: str, content: bytes, include_body: bool = True) -> tuple:
     """
-    記事URLをスクレイピングしてOGPや本文からメイン画像を取得する
-    (すべてのコレクターモジュールから呼び出される)
+    [内部] HTML (または <head> 部分) をパースし、(画像候補リスト, canonical URL) を返す。
+    パースは CPU 処理なので、イベントループを止めないよう parse_pool (別プロセス / スレッド) で行う
     """
-    fetched = fetch_html(article_url)
-    if not fetched:
+    return await run_parse_async(extract_page_info, final_url, content, include_body)
+
+
+def _find_head_end(buf: bytearray, start: int = 0) -> int:
+    """[内部] バイト列中の </head> の位置を返す (無ければ -1)"""
+    pos = bytes(buf[start:]).lower().find(b"</head")
+    return pos + start if pos >= 0 else -1
+
+
+@timed("page.fetch_head")
+async def _fetch_head_async(url: str, timeout: float = HTTP_TIMEOUT) -> Optional[tuple]:
+    """
+    [内部] ページを先頭からストリーミングで読み、</head> か HEAD_BYTE_LIMIT に達した時点で
+    (最終URL, 画像候補, canonical URL, 全文 or None) を返す。
+    <head> に画像候補が無いページは、後段で本文の <img> が必要になるので
+    同じ接続のまま最後まで読み切って全文も返す (2 回目のリクエストを避ける)。
+    """
+    try:
+        async with get_engine().stream("GET", url, timeout=timeout) as resp:
+            resp.raise_for_status()
+            final_url = str(resp.url)
+            chunks = resp.aiter_bytes()
+            buf = bytearray()
+            head_end = -1
+            async for chunk in chunks:
+                scan_from = max(0, len(buf) - 6)
+                buf += chunk
+                head_end = _find_head_end(buf, scan_from)
+                if head_end >= 0 or len(buf) >= HEAD_BYTE_LIMIT:
+                    break
+            head = bytes(buf[:head_end]) if head_end >= 0 else bytes(buf)
+            candidates, canonical_url = await _extract_page_info_async(final_url, head, False)
+            body = None
+            if not candidates:
+                async for chunk in chunks:
+                    buf += chunk
+                    if len(buf) >= MAX_PAGE_BYTES:
+                        break
+                body = bytes(buf)
+            return final_url, candidates, canonical_url, body
+    except (httpx.HTTPError, httpx.InvalidURL, HostUnavailableError) as e:
+        print(f" [fetch_html エラー] {url} : {e}")
         return None
-    final_url, soup = fetched
-
-    # 1) OGP / Twitter
-    meta_keys = [
-        ("meta", {"property": "og:image"}, "content"),
-        ("meta", {"property": "og:image:secure_url"}, "content"),
-        ("meta", {"name": "twitter:image"}, "content"),
-    ]
-    for tag, attrs, attrname in meta_keys:
-        t = soup.find(tag, attrs=attrs)
-        if t and t.get(attrname):
-            cand = requests.compat.urljoin(final_url, t.get(attrname))
-            if validate_image_url(cand):
-                return cand
-
-    # 2) JSON-LD
-    for script in soup.find_all("script", type="application/ld+json"):
-        try:
-            txt = script.string
-            if not txt: continue
-            data = json.loads(txt)
-            items = data if isinstance(data, list) else [data]
-            for it in items:
-                if isinstance(it, dict):
-                    img = it.get("image") or it.get("thumbnailUrl")
-                    if isinstance(img, str):
-                        cand = requests.compat.urljoin(final_url, img)
-                        if validate_image_url(cand): return cand
-                    elif isinstance(img, dict):
-                        urlf = img.get("url")
-                        if urlf:
-                            cand = requests.compat.urljoin(final_url, urlf)
-                            if validate_image_url(cand): return cand
-                    elif isinstance(img, list):
-                        for it2 in img:
-                            if isinstance(it2, str):
-                                cand = requests.compat.urljoin(final_url, it2)
-                                if validate_image_url(cand): return cand
-        except Exception:
-            continue
-
-    # 3) 本文中画像
-    selectors = ["article", "main", "[role='main']", ".post-content", ".article-body", "#content"]
-    main_content = None
-    for s in selectors:
-        main_content = soup.select_one(s)
-        if main_content: break
-    if not main_content:
-        main_content = soup.body
-
-    if main_content:
-        for img in main_content.find_all("img", src=True):
-            src = img.get("src")
-            if not src or src.startswith("data:"): continue
-            cand = requests.compat.urljoin(final_url, src)
-            if validate_image_url(cand):
-                return cand
-    return None
\ No newline at end of file
+
+
+_validation_slots: Optional[asyncio.Semaphore] = None
+
+
+async def _validate_limited(img_url: str) -> Optional[bool]:
+    """
+    [内部] 全呼び出しで共有する同時検証数 (IMAGE_VALIDATION_WORKERS) を守って検証する
+    (判定できなかった場合は None。_check_image_url_async を参照)
+    """
+    global _validation_slots
+    if _validation_slots is None:
+        _validation_slots = asyncio.Semaphore(IMAGE_VALIDATION_WORKERS)
+    async with _validation_slots:
+        return await _check_image_url_async(img_url)
+
+
+async def _first_valid_image_async(candidates: List[str]) -> Tuple[Optional[str], bool]:
+    """
+    [内部] 候補を並列に検証し、(優先度が最も高い有効な画像URL, 判定できたか) を返す
+    上位の候補の結果が出揃った時点で確定し、残りの検証は取り消す
+    有効な画像が無く、通信エラーなどで判定できなかった候補があれば「判定できたか」は False
+    """
+    if not candidates:
+        return None, True
+    tasks = [asyncio.ensure_future(_validate_limited(cand)) for cand in candidates]
+    decided = True
+    try:
+        for cand, task in zip(candidates, tasks):
+            try:
+                valid = await task
+            except Exception:
+                valid = None
+            if valid:
+                return cand, True
+            if valid is None:
+                decided = False
+        return None, decided
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def remember_article_images(mapping: dict) -> int:
+    """
+    既知の 記事URL → 画像URL (None は画像なし) を ARTICLE_IMAGE_CACHE に登録する
+    (DB に保存済みの記事を再スクレイピングしないため、main.py から呼び出される)
+    DB から毎回読み込む値なので、メモリ上にだけ登録する (SQLite への書き込みや TTL の更新はしない)
+    """
+    for article_url, image_url in mapping.items():
+        if article_url:
+            ARTICLE_IMAGE_CACHE.seed(article_url, image_url or None)
+    return len(mapping)
+
+
+@timed("image.get_main_image")
+async def get_main_image_async(article_url: str, use_cache: bool = True) -> Optional[str]:
+    """
+    記事URLをスクレイピングしてOGPや本文からメイン画像を取得する (非同期版)
+    まず <head> だけを読んで OGP / JSON-LD の候補を検証し、無ければ本文の <img> も見る
+    候補は並列に検証し、優先度順で最初に有効なものを返す
+    解決済みの記事URLは ARTICLE_IMAGE_CACHE から返し、HTML を取得しない
+    """
+    if use_cache:
+        cached = ARTICLE_IMAGE_CACHE.get(article_url)
+        if cached is not MISSING:
+            incr("image.main_image", label="cached")
+            return cached
+
+    # 1) <head> だけを読み、OGP / Twitter / JSON-LD の候補を検証する
+    head = await _fetch_head_async(article_url)
+    if not head:
+        # 取得失敗は一時的な可能性があるのでキャッシュしない
+        incr("image.main_image", label="fetch_failed")
+        return None
+    final_url, candidates, canonical_url, body = head
+
+    # <link rel="canonical"> を記録し、重複除去 (url_normalizer) で使う
+    if canonical_url:
+        remember_canonical_url(article_url, canonical_url)
+
+    image_url, decided = await _first_valid_image_async(candidates)
+
+    # 2) 見つからなければ全文をパースして本文中の <img> も候補にする
+    if image_url:
+        incr("image.main_image", label="head")
+    else:
+        if body is None:
+            page = await _fetch_page_async(article_url)
+            if not page:
+                incr("image.main_image", label="fetch_failed")
+                return None
+            final_url, body = page
+        body_candidates, _ = await _extract_page_info_async(final_url, body)
+        image_url, body_decided = await _first_valid_image_async([c for c in body_candidates if c not in candidates])
+        decided = decided and body_decided
+        incr("image.main_image", label="body" if image_url else ("none" if decided else "undecided"))
+
+    # 画像なしは、すべての候補を判定できたときだけキャッシュする
+    # (通信エラーで判定できなかった候補がある場合は一時的な失敗の可能性があるため、次回もう一度探す)
+    if use_cache and (image_url or decided):
+        ARTICLE_IMAGE_CACHE.set(article_url, image_url)
+    return image_url
+
+
+def get_main_image(article_url: str, use_cache: bool = True) -> Optional[str]:
+    """
+    記事URLをスクレイピングしてOGPや本文からメイン画像を取得する
+    (すべてのコレクターモジュールから呼び出される。get_main_image_async の同期版)
+    """
+    return get_engine().run(get_main_image_async(article_url, use_cache))